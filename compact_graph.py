@@ -0,0 +1,147 @@
+from kg_gen import Graph
+from array import array
+import json
+
+
+# A graph built from many chunks, stored compactly
+# Entity and relation names are interned to integer ids, edges are parallel
+# integer arrays, and each chunk's tags are serialized once in a chunk table
+# that entities and edges refer to by index
+class CompactGraph:
+	def __init__(self):
+		# id -> name, name -> id
+		# Names that only appear in relations are interned but have no chunks
+		self.entities = []
+		self.entity_ids = {}
+		self.relation_names = []
+		self.relation_ids = {}
+
+		# Edge i is edge_src[i] -{edge_rel[i]}-> edge_dst[i]
+		self.edge_src = array("i")
+		self.edge_rel = array("i")
+		self.edge_dst = array("i")
+		self.edge_ids = {}
+
+		# Chunk i's tags (as json) and checkpoint
+		self.chunk_tags = []
+		self.chunk_checkpoints = []
+
+		# Entity/edge id -> chunk ids
+		self.entity_chunks = []
+		self.edge_chunks = []
+
+		# Relation ids found in the chunk graphs' edges
+		self.edge_names = set()
+
+	@classmethod
+	def from_chunks(cls, chunks):
+		graph = cls()
+		for chunk in chunks:
+			graph.add_chunk(chunk)
+		return graph
+
+	def _entity_id(self, name):
+		if (i := self.entity_ids.get(name)) is None:
+			i = len(self.entities)
+			self.entity_ids[name] = i
+			self.entities.append(name)
+			self.entity_chunks.append(array("i"))
+		return i
+
+	def _relation_id(self, name):
+		if (i := self.relation_ids.get(name)) is None:
+			i = len(self.relation_names)
+			self.relation_ids[name] = i
+			self.relation_names.append(name)
+		return i
+
+	def _edge_id(self, a, r, b):
+		key = (self._entity_id(a), self._relation_id(r), self._entity_id(b))
+		if (i := self.edge_ids.get(key)) is None:
+			i = len(self.edge_src)
+			self.edge_ids[key] = i
+			self.edge_src.append(key[0])
+			self.edge_rel.append(key[1])
+			self.edge_dst.append(key[2])
+			self.edge_chunks.append(array("i"))
+		return i
+
+	def add_chunk(self, chunk):
+		chunk_i = len(self.chunk_tags)
+		self.chunk_tags.append(json.dumps(chunk["tags"]))
+		self.chunk_checkpoints.append(chunk["tags"]["checkpoint"])
+
+		graph = chunk["graph"]
+		for entity in graph.entities:
+			self.entity_chunks[self._entity_id(entity)].append(chunk_i)
+		for a, r, b in graph.relations:
+			self.edge_chunks[self._edge_id(a, r, b)].append(chunk_i)
+		for r in graph.edges:
+			self.edge_names.add(self._relation_id(r))
+
+	# The same as json.dumps of the list of those chunks' tags
+	def tags_json(self, chunk_ids):
+		return "[" + ", ".join(self.chunk_tags[i] for i in chunk_ids) + "]"
+
+	def checkpoints(self, chunk_ids):
+		return sorted(self.chunk_checkpoints[i] for i in chunk_ids)
+
+	def edge(self, i):
+		return (
+			self.entities[self.edge_src[i]],
+			self.relation_names[self.edge_rel[i]],
+			self.entities[self.edge_dst[i]],
+		)
+
+	# entity -> tags json, for every entity found in a chunk
+	def entity_references(self):
+		ids = [i for i, chunks in enumerate(self.entity_chunks) if len(chunks) > 0]
+		return References(self, ids, self.entities.__getitem__, self.entity_chunks)
+
+	# (a, relation, b) -> tags json
+	def relationship_references(self):
+		return References(self, range(len(self.edge_src)), self.edge, self.edge_chunks)
+
+	# The same graph kg.aggregate would make from the chunk graphs
+	def to_graph(self):
+		return Graph(
+			entities = set(self.entities[i] for i, chunks in enumerate(self.entity_chunks) if len(chunks) > 0),
+			relations = set(self.edge(i) for i in range(len(self.edge_src))),
+			edges = set(self.relation_names[i] for i in self.edge_names),
+		)
+
+
+# A read-only view of some entities or edges of a CompactGraph
+# Used like a dict of key -> tags json, where the json is made on demand
+class References:
+	def __init__(self, graph, ids, key, chunks):
+		self.graph = graph
+		self.ids = ids
+		self.key = key
+		self.chunks = chunks
+
+	def __len__(self):
+		return len(self.ids)
+
+	def keys(self):
+		for i in self.ids:
+			yield self.key(i)
+
+	def items(self):
+		for i in self.ids:
+			yield self.key(i), self.graph.tags_json(self.chunks[i])
+
+	# key -> chunk ids
+	def chunk_items(self):
+		for i in self.ids:
+			yield self.key(i), self.chunks[i]
+
+	def subset(self, ids):
+		return References(self.graph, ids, self.key, self.chunks)
+
+	# Splits a view of edges into {relation name: view}
+	def by_relation(self):
+		groups = {}
+		for i in self.ids:
+			groups.setdefault(self.graph.relation_names[self.graph.edge_rel[i]], []).append(i)
+		return {r: self.subset(ids) for r, ids in groups.items()}
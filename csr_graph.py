@@ -0,0 +1,293 @@
+from compact_graph import CompactGraph
+from array import array
+from collections import deque
+import networkx as nx
+import threading
+import argparse
+import storage
+import mmap
+import json
+import os
+
+# Files written to a graph's csr directory, each a flat array of int32s
+array_files = [
+	# Entity i's adjacencies are [offsets[i], offsets[i+1])
+	"offsets",
+	# The entity and edge of each adjacency (edges are listed both ways)
+	"neighbours",
+	"adjacent_edges",
+	"edge_src",
+	"edge_rel",
+	"edge_dst",
+	# Edge i's chunks are edge_chunks[edge_chunk_offsets[i]:edge_chunk_offsets[i+1]]
+	"edge_chunk_offsets",
+	"edge_chunks",
+	"entity_chunk_offsets",
+	"entity_chunks",
+]
+
+
+def _flatten(lists):
+	offsets = array("i", [0])
+	values = array("i")
+	for l in lists:
+		values.extend(l)
+		offsets.append(len(values))
+	return offsets, values
+
+
+# Builds the csr files for a directory of chunk checkpoints
+# Only keeps relations between entities, like the database uploads do
+def build(chunks_dir, store=None):
+	close_store = store is None
+	if store is None:
+		store = storage.open_chunk_store(chunks_dir)
+	print("Building csr graph")
+	compact = CompactGraph.from_chunks(store)
+	if close_store:
+		store.close()
+
+	# Entity ids without the names that only appear in relations
+	entity_map = {}
+	entities = []
+	for i, chunks in enumerate(compact.entity_chunks):
+		if len(chunks) > 0:
+			entity_map[i] = len(entities)
+			entities.append(i)
+
+	edges = [
+		i for i in range(len(compact.edge_src))
+		if compact.edge_src[i] in entity_map and compact.edge_dst[i] in entity_map
+	]
+	edge_src = array("i", (entity_map[compact.edge_src[i]] for i in edges))
+	edge_rel = array("i", (compact.edge_rel[i] for i in edges))
+	edge_dst = array("i", (entity_map[compact.edge_dst[i]] for i in edges))
+
+	adjacency = [[] for _ in entities]
+	for edge, (a, b) in enumerate(zip(edge_src, edge_dst)):
+		adjacency[a].append((b, edge))
+		if a != b:
+			adjacency[b].append((a, edge))
+	offsets, neighbours = _flatten([b for b, _ in adj] for adj in adjacency)
+	_, adjacent_edges = _flatten([edge for _, edge in adj] for adj in adjacency)
+
+	edge_chunk_offsets, edge_chunks = _flatten(compact.edge_chunks[i] for i in edges)
+	entity_chunk_offsets, entity_chunks = _flatten(compact.entity_chunks[i] for i in entities)
+
+	arrays = {
+		"offsets": offsets,
+		"neighbours": neighbours,
+		"adjacent_edges": adjacent_edges,
+		"edge_src": edge_src,
+		"edge_rel": edge_rel,
+		"edge_dst": edge_dst,
+		"edge_chunk_offsets": edge_chunk_offsets,
+		"edge_chunks": edge_chunks,
+		"entity_chunk_offsets": entity_chunk_offsets,
+		"entity_chunks": entity_chunks,
+	}
+	csr_dir = f"{chunks_dir}/csr"
+	os.makedirs(csr_dir, exist_ok=True)
+	# Replaced rather than rewritten, a server may have the old files mapped
+	for name in array_files:
+		temp_path = f"{csr_dir}/{name}.bin.{os.getpid()}.tmp"
+		with open(temp_path, "wb") as f:
+			arrays[name].tofile(f)
+		os.replace(temp_path, f"{csr_dir}/{name}.bin")
+	# The meta goes last, it's what readers check for
+	storage.save_json({
+		"entities": [compact.entities[i] for i in entities],
+		"relations": compact.relation_names,
+		"chunk_tags": compact.chunk_tags,
+		"lengths": {name: len(arrays[name]) for name in array_files},
+	}, f"{csr_dir}/meta.json")
+	print(f"\tWrote {len(entities)} entities, {len(edges)} relations to '{csr_dir}'")
+
+
+# A graph loaded from memory-mapped csr files
+# Answers the same traversals as the graph databases without needing one
+class CSRGraph:
+	def __init__(self, chunks_dir):
+		csr_dir = f"{chunks_dir}/csr"
+		meta = storage.load_json(f"{csr_dir}/meta.json")
+		self.entities = meta["entities"]
+		self.entity_ids = {e: i for i, e in enumerate(self.entities)}
+		self.relations = meta["relations"]
+		self.chunk_tags = meta["chunk_tags"]
+
+		self._maps = []
+		for name in array_files:
+			setattr(self, name, self._map(f"{csr_dir}/{name}.bin"))
+		# Opened halfway through a rebuild, the arrays don't match the meta
+		lengths = meta.get("lengths", {})
+		if any(len(getattr(self, name)) != length for name, length in lengths.items()):
+			self.close()
+			raise ValueError(f"'{csr_dir}' is being rebuilt")
+
+	def _map(self, path):
+		with open(path, "rb") as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				return memoryview(b"").cast("i")
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self._maps.append(m)
+		return memoryview(m).cast("i")
+
+	def close(self):
+		for name in array_files:
+			getattr(self, name).release()
+		for m in self._maps:
+			m.close()
+		self._maps = []
+
+	def __len__(self):
+		return len(self.entities)
+
+	def adjacent(self, i):
+		st, en = self.offsets[i], self.offsets[i+1]
+		return zip(self.neighbours[st:en], self.adjacent_edges[st:en])
+
+	def edge_tags(self, edge):
+		st, en = self.edge_chunk_offsets[edge], self.edge_chunk_offsets[edge+1]
+		return [json.loads(self.chunk_tags[c]) for c in self.edge_chunks[st:en]]
+
+	def entity_tags(self, entity):
+		st, en = self.entity_chunk_offsets[entity], self.entity_chunk_offsets[entity+1]
+		return [json.loads(self.chunk_tags[c]) for c in self.entity_chunks[st:en]]
+
+	# Relation names as they come back from the database
+	def relation_name(self, edge):
+		return storage.from_neo4j_repr(storage.to_neo4j_repr(self.relations[self.edge_rel[edge]]))
+
+	# Breadth first search up to k hops
+	# Returns {entity: distance}, {entity: [(previous entity, edge)]}
+	def _bfs(self, start, k):
+		distance = {start: 0}
+		previous = {}
+		frontier = deque([start])
+		while frontier:
+			a = frontier.popleft()
+			if distance[a] == k:
+				continue
+			for b, edge in self.adjacent(a):
+				if b not in distance:
+					distance[b] = distance[a] + 1
+					frontier.append(b)
+				if distance[b] == distance[a] + 1:
+					previous.setdefault(b, []).append((a, edge))
+		return distance, previous
+
+	# Every shortest path to b as ([entities], [edges])
+	def _paths_to(self, b, previous):
+		if b not in previous:
+			return [([b], [])]
+		paths = []
+		for a, edge in previous[b]:
+			for nodes, edges in self._paths_to(a, previous):
+				paths.append((nodes + [b], edges + [edge]))
+		return paths
+
+	def _path_result(self, nodes, edges):
+		return (
+			storage.from_neo4j_repr(self.entities[nodes[-1]]),
+			[storage.from_neo4j_repr(self.entities[n]) for n in nodes],
+			[self.relation_name(e) for e in edges],
+			[self.edge_tags(e) for e in edges],
+		)
+
+	# Same as query.k_hops_neighbours_neo4j
+	# [(node, nodes to get there, edges to get there, sources for those edges)]
+	def k_hops_neighbours(self, e, k=2):
+		if (start := self.entity_ids.get(e)) is None:
+			return []
+		distance, previous = self._bfs(start, k)
+
+		result = []
+		# Self relations are the only way a 1-hop path comes back to e
+		for b, edge in self.adjacent(start):
+			if b == start:
+				result.append(self._path_result([start, start], [edge]))
+		for b in sorted(distance.keys(), key=lambda b: distance[b]):
+			if b == start:
+				continue
+			for nodes, edges in self._paths_to(b, previous):
+				result.append(self._path_result(nodes, edges))
+		return result
+
+	def k_hops_neighbours_batch(self, es, k=2):
+		return {e: self.k_hops_neighbours(e, k) for e in es}
+
+	# One shortest path from a to b as (nodes, edges, sources), or None
+	def shortest_path(self, a, b, max_hops=None):
+		start = self.entity_ids.get(a)
+		end = self.entity_ids.get(b)
+		if start is None or end is None:
+			return None
+		distance, previous = self._bfs(start, max_hops if max_hops is not None else len(self.entities))
+		if end not in distance:
+			return None
+		nodes, edges = self._paths_to(end, previous)[0]
+		_, nodes, edges, sources = self._path_result(nodes, edges)
+		return nodes, edges, sources
+
+	# The sources of relation a -r-> b, or None if there isn't one
+	def relation_tags(self, a, r, b):
+		start = self.entity_ids.get(a)
+		end = self.entity_ids.get(b)
+		if start is None or end is None:
+			return None
+		for n, edge in self.adjacent(start):
+			if n == end and self.edge_src[edge] == start and self.relations[self.edge_rel[edge]] == r:
+				return self.edge_tags(edge)
+		return None
+
+	# Looks like the graph that labels.nx_graph_neo4j exports
+	def to_networkx(self):
+		graph = nx.DiGraph()
+		for i, e in enumerate(self.entities):
+			graph.add_node(str(i), id=e, tags=json.dumps(self.entity_tags(i)))
+		for a, b in zip(self.edge_src, self.edge_dst):
+			graph.add_edge(str(a), str(b))
+		return graph
+
+
+# Loads a directory's csr graph, building it first if needed
+def load(chunks_dir):
+	if not os.path.isfile(f"{chunks_dir}/csr/meta.json"):
+		build(chunks_dir)
+	return CSRGraph(chunks_dir)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+# One open csr graph per directory for the whole process, reopened when the
+# graph version changes (process.py --csr bumps it after rebuilding)
+# The old graph is kept if the new files can't be opened yet
+def shared(chunks_dir, version_file=storage.graph_version_file):
+	version = storage.load_graph_version(version_file)
+	with _shared_lock:
+		graph, graph_version = _shared.get(chunks_dir, (None, None))
+		if graph is None:
+			graph = load(chunks_dir)
+		elif graph_version != version:
+			try:
+				# The old one may still be in use, it's left for the gc
+				graph = CSRGraph(chunks_dir)
+			except (OSError, ValueError) as e:
+				print(f"Keeping the old csr graph: {e}")
+				return graph
+		_shared[chunks_dir] = (graph, version)
+		return graph
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir")
+	args = parser.parse_args()
+
+	build(args.dir)
+
+
+if __name__ == "__main__":
+	main()
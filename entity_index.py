@@ -0,0 +1,214 @@
+from compact_graph import CompactGraph
+import numpy as np
+import argparse
+import storage
+import os
+
+# Character n-grams of this length are the index's features
+ngram_size = 3
+# Matches scoring less than this (cosine similarity) are ignored
+default_min_score = 0.5
+
+
+def normalize(entity):
+	return " ".join(entity.lower().split())
+
+
+# {n-gram: count} of an entity, padded so short entities and word
+# boundaries still make n-grams
+def ngrams(entity):
+	padded = f" {normalize(entity)} "
+	counts = {}
+	for i in range(len(padded) - ngram_size + 1):
+		gram = padded[i:i+ngram_size]
+		counts[gram] = counts.get(gram, 0) + 1
+	return counts
+
+
+# Character n-gram TF-IDF vectors of every entity in the graph
+# The entity matrix is kept column-wise (n-gram -> entities that have it) so
+# a batch of queries only touches the entries of the n-grams they contain
+class EntityIndex:
+	def __init__(self, entities, vocabulary, idf, col_ptr, rows, weights):
+		self.entities = entities
+		self.entity_set = set(entities)
+		self.vocabulary = vocabulary
+		self.features = {gram: i for i, gram in enumerate(vocabulary)}
+		self.idf = idf
+		self.col_ptr = col_ptr
+		self.rows = rows
+		self.weights = weights
+
+	@classmethod
+	def from_entities(cls, entities):
+		entities = list(entities)
+		features = {}
+		entity_ids = []
+		feature_ids = []
+		counts = []
+		for i, entity in enumerate(entities):
+			for gram, count in ngrams(entity).items():
+				entity_ids.append(i)
+				feature_ids.append(features.setdefault(gram, len(features)))
+				counts.append(count)
+		entity_ids = np.array(entity_ids, dtype=np.int32)
+		feature_ids = np.array(feature_ids, dtype=np.int32)
+		counts = np.array(counts, dtype=np.float32)
+
+		# Smoothed idf, like sklearn's
+		df = np.bincount(feature_ids, minlength=len(features))
+		idf = (np.log((1 + len(entities)) / (1 + df)) + 1).astype(np.float32)
+		weights = (1 + np.log(counts)) * idf[feature_ids]
+		norms = np.sqrt(np.bincount(entity_ids, weights=weights**2, minlength=len(entities)))
+		weights /= norms[entity_ids]
+
+		order = np.argsort(feature_ids, kind="stable")
+		col_ptr = np.zeros(len(features) + 1, dtype=np.int64)
+		np.cumsum(df, out=col_ptr[1:])
+		return cls(
+			entities,
+			list(features.keys()),
+			idf,
+			col_ptr,
+			entity_ids[order],
+			weights[order].astype(np.float32),
+		)
+
+	# The queries' vectors as (query, n-gram, weight) arrays
+	def _query_vectors(self, queries):
+		query_ids = []
+		feature_ids = []
+		weights = []
+		norms = np.ones(len(queries), dtype=np.float32)
+		# What idf would give an n-gram no entity has
+		unknown_idf = np.log(1 + len(self.entities)) + 1
+		for i, q in enumerate(queries):
+			squares = 0
+			for gram, count in ngrams(q).items():
+				f = self.features.get(gram)
+				weight = (1 + np.log(count)) * (self.idf[f] if f is not None else unknown_idf)
+				squares += weight**2
+				# n-grams no entity has can't match anything, but they still
+				# count towards the query's norm
+				if f is not None:
+					query_ids.append(i)
+					feature_ids.append(f)
+					weights.append(weight)
+			if squares > 0:
+				norms[i] = np.sqrt(squares)
+		query_ids = np.array(query_ids, dtype=np.int64)
+		feature_ids = np.array(feature_ids, dtype=np.int64)
+		weights = np.array(weights, dtype=np.float32)
+		return query_ids, feature_ids, weights / norms[query_ids]
+
+	# Cosine similarity of every query with every entity, as a (queries, entities) array
+	def scores(self, queries):
+		query_ids, feature_ids, query_weights = self._query_vectors(queries)
+
+		# Every (query n-gram, entity with that n-gram) pair
+		starts = self.col_ptr[feature_ids]
+		lengths = self.col_ptr[feature_ids + 1] - starts
+		pair_query = np.repeat(query_ids, lengths)
+		pair_weight = np.repeat(query_weights, lengths)
+		offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+		postings = np.repeat(starts, lengths) + offsets
+
+		scores = np.bincount(
+			pair_query * len(self.entities) + self.rows[postings],
+			weights=pair_weight * self.weights[postings],
+			minlength=len(queries) * len(self.entities),
+		)
+		return scores.reshape(len(queries), len(self.entities))
+
+	# The top k (entity, score) matches of each query, best first
+	def search(self, queries, k=5, min_score=default_min_score):
+		if len(queries) == 0 or len(self.entities) == 0:
+			return [[] for _ in queries]
+		scores = self.scores(queries)
+		k = min(k, len(self.entities))
+		top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+		top_scores = np.take_along_axis(scores, top, axis=1)
+		order = np.argsort(-top_scores, axis=1, kind="stable")
+		top = np.take_along_axis(top, order, axis=1)
+		top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+		return [
+			[(self.entities[e], float(s)) for e, s in zip(row, row_scores) if s >= min_score]
+			for row, row_scores in zip(top, top_scores)
+		]
+
+	# The graph entity each query entity most likely means
+	# Query entities that are already graph entities are kept as they are,
+	# n-grams ignore case so they could match a different one
+	# Entities without a good enough match are left out
+	def link(self, queries, min_score=default_min_score):
+		misses = [q for q in queries if q not in self.entity_set]
+		found = dict(zip(misses, self.search(misses, 1, min_score)))
+		linked = []
+		for q in queries:
+			if q not in found:
+				linked.append(q)
+				continue
+			matches = found[q]
+			if len(matches) > 0:
+				print(f"linked '{q}' to '{matches[0][0]}' ({matches[0][1]:.2f})")
+				linked.append(matches[0][0])
+			else:
+				print(f"no entity like '{q}'")
+		return list(dict.fromkeys(linked))
+
+	def save(self, path):
+		os.makedirs(path, exist_ok=True)
+		storage.save_json({"entities": self.entities, "vocabulary": self.vocabulary}, f"{path}/names.json")
+		np.savez(f"{path}/matrix.npz", idf=self.idf, col_ptr=self.col_ptr, rows=self.rows, weights=self.weights)
+
+	@classmethod
+	def load(cls, path):
+		names = storage.load_json(f"{path}/names.json")
+		with np.load(f"{path}/matrix.npz") as matrix:
+			return cls(
+				names["entities"],
+				names["vocabulary"],
+				matrix["idf"],
+				matrix["col_ptr"],
+				matrix["rows"],
+				matrix["weights"],
+			)
+
+
+# Builds the index of a directory of chunk checkpoints
+def build(chunks_dir, store=None):
+	close_store = store is None
+	if store is None:
+		store = storage.open_chunk_store(chunks_dir)
+	print("Building entity index")
+	graph = CompactGraph.from_chunks(store)
+	if close_store:
+		store.close()
+
+	index = EntityIndex.from_entities(graph.entity_references().keys())
+	index.save(f"{chunks_dir}/entity_index")
+	print(f"\tIndexed {len(index.entities)} entities, {len(index.vocabulary)} n-grams")
+	return index
+
+
+# Loads a directory's entity index, building it first if needed
+def load(chunks_dir):
+	if not os.path.isfile(f"{chunks_dir}/entity_index/matrix.npz"):
+		return build(chunks_dir)
+	return EntityIndex.load(f"{chunks_dir}/entity_index")
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir")
+	parser.add_argument("entities", nargs="*", help="entities to look up once built")
+	args = parser.parse_args()
+
+	index = build(args.dir)
+	for entity, matches in zip(args.entities, index.search(args.entities)):
+		print(f"{entity}: {matches}")
+
+
+if __name__ == "__main__":
+	main()
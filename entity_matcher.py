@@ -0,0 +1,113 @@
+from collections import deque
+import entity_index
+import argparse
+import regex as re
+
+# Entities that are just one of these would match almost every question
+stop_words = {
+	"a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+	"from", "has", "have", "how", "i", "if", "in", "is", "it", "its", "of", "on",
+	"or", "should", "that", "the", "their", "them", "there", "these", "they",
+	"this", "to", "was", "we", "what", "when", "where", "which", "who", "why",
+	"will", "with", "you", "your",
+}
+
+
+def tokens(text):
+	return re.findall(r"[\p{L}\p{N}]+", text.lower())
+
+
+# Finds the graph's entities in a question without asking the LM
+# An Aho-Corasick automaton over words, so every entity is found in one pass
+# over the question and entities only match whole words
+class EntityMatcher:
+	def __init__(self, entities):
+		# Trie node -> {word: node}, failure link, entities ending here and
+		# how many words they have
+		self.goto = [{}]
+		self.fail = [0]
+		self.output = [[]]
+		self.depth = [0]
+
+		for entity in entities:
+			words = tokens(entity)
+			if len(words) == 0 or (len(words) == 1 and (words[0] in stop_words or len(words[0]) < 3)):
+				continue
+			node = 0
+			for word in words:
+				if (next_node := self.goto[node].get(word)) is None:
+					next_node = len(self.goto)
+					self.goto[node][word] = next_node
+					self.goto.append({})
+					self.fail.append(0)
+					self.output.append([])
+					self.depth.append(self.depth[node] + 1)
+				node = next_node
+			self.output[node].append(entity)
+
+		# The closest node on the failure chain with entities, so matches
+		# ending inside longer ones are found too
+		self.output_link = [0] * len(self.goto)
+		frontier = deque(self.goto[0].values())
+		while frontier:
+			node = frontier.popleft()
+			for word, child in self.goto[node].items():
+				fail = self.fail[node]
+				while fail != 0 and word not in self.goto[fail]:
+					fail = self.fail[fail]
+				self.fail[child] = self.goto[fail].get(word, 0)
+				f = self.fail[child]
+				self.output_link[child] = f if len(self.output[f]) > 0 else self.output_link[f]
+				frontier.append(child)
+
+	def __len__(self):
+		return sum(len(o) for o in self.output)
+
+	# Every (first word, last word + 1, entities) found in text
+	def find(self, text):
+		words = tokens(text)
+		matches = []
+		node = 0
+		for i, word in enumerate(words):
+			while node != 0 and word not in self.goto[node]:
+				node = self.fail[node]
+			node = self.goto[node].get(word, 0)
+
+			out = node if len(self.output[node]) > 0 else self.output_link[node]
+			while out != 0:
+				matches.append((i + 1 - self.depth[out], i + 1, self.output[out]))
+				out = self.output_link[out]
+		return matches
+
+	# The entities in text, longest first where they overlap, in the order
+	# they appear
+	def match(self, text):
+		matches = sorted(self.find(text), key=lambda m: (m[0], -m[1]))
+		entities = []
+		end = 0
+		for st, en, found in matches:
+			if st < end:
+				continue
+			entities.extend(found)
+			end = en
+		return list(dict.fromkeys(entities))
+
+
+# A matcher for the entities of a directory's entity index
+def load(chunks_dir):
+	return EntityMatcher(entity_index.load(chunks_dir).entities)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir")
+	parser.add_argument("question")
+	args = parser.parse_args()
+
+	matcher = load(args.dir)
+	print(f"{len(matcher)} entities")
+	print(matcher.match(args.question))
+
+
+if __name__ == "__main__":
+	main()
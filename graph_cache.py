@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import threading
+import storage
+import time
+import os
+
+# How often (in seconds) the graph version file is checked
+version_check_interval = 1.0
+
+
+# An in-memory cache of things worked out from the uploaded graph
+# Entries expire after ttl seconds, the least recently used are evicted past
+# max_entries, and everything is dropped when the graph version changes
+class GraphCache:
+	def __init__(self, max_entries, ttl, version_file=storage.graph_version_file):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.version_file = version_file
+		self.version = storage.load_graph_version(version_file) if version_file else None
+		self.version_checked = time.monotonic()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+		# key -> (value, expiry time)
+		self.entries = OrderedDict()
+		# Shared by the server's requests
+		self.lock = threading.Lock()
+
+	def _check_version(self):
+		if self.version_file is None:
+			return
+		now = time.monotonic()
+		if now - self.version_checked < version_check_interval:
+			return
+		self.version_checked = now
+		version = storage.load_graph_version(self.version_file)
+		if version != self.version:
+			self.version = version
+			self.entries.clear()
+			self.invalidations += 1
+
+	# The live value for key, must hold the lock
+	def _lookup(self, key):
+		self._check_version()
+		entry = self.entries.get(key)
+		if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+			return None
+		return entry[0]
+
+	def get(self, key):
+		with self.lock:
+			value = self._lookup(key)
+			if value is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self._check_version()
+			self._put(key, value)
+
+	def _put(self, key, value):
+		expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+		self.entries[key] = (value, expiry)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"entries": len(self.entries),
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+				"evictions": self.evictions,
+				"invalidations": self.invalidations,
+			}
+
+
+# Entity -> k-hop neighbourhood, shared between queries
+# A neighbourhood fetched with k hops also answers any smaller k, those are
+# just its paths with at most that many edges
+class NeighbourhoodCache(GraphCache):
+	def __init__(
+		self,
+		max_entries=int(os.getenv("NEIGHBOURHOOD_CACHE_SIZE", "4096")),
+		ttl=float(os.getenv("NEIGHBOURHOOD_CACHE_TTL", "3600")),
+		version_file=storage.graph_version_file,
+	):
+		super().__init__(max_entries, ttl, version_file)
+
+	# The neighbours up to k hops away, or None if they aren't cached
+	def get(self, e, k):
+		with self.lock:
+			entry = self._lookup(e)
+			if entry is None or entry[0] < k:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.entries.move_to_end(e)
+			cached_k, neighbours = entry
+
+		if cached_k == k:
+			return neighbours
+		return [n for n in neighbours if len(n[2]) <= k]
+
+	def put(self, e, k, neighbours):
+		with self.lock:
+			entry = self._lookup(e)
+			# Don't replace a bigger neighbourhood that's still good
+			if entry is not None and entry[0] > k:
+				return
+			self._put(e, (k, neighbours))
+
+
+# A cache for the lookups of a single query, nothing expires
+def query_cache():
+	return NeighbourhoodCache(max_entries=float("inf"), ttl=None, version_file=None)
+
+
+# question, k -> query result, for the server
+class AnswerCache(GraphCache):
+	def __init__(
+		self,
+		max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+		ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+		version_file=storage.graph_version_file,
+	):
+		super().__init__(max_entries, ttl, version_file)
+
+	# Questions that only differ in case, spacing or final punctuation are the same
+	@staticmethod
+	def key(question, k):
+		return " ".join(question.lower().split()).rstrip("?!. "), k
@@ -3,6 +3,7 @@ import networkx as nx
 import itertools
 import os
 import dspy
+import ledger
 from neo4j import GraphDatabase
 import json
 from functools import reduce
@@ -148,21 +149,32 @@ def _label_entities(entities):
 	return _label_community_p(entities=entities).label
 
 
-def _add_labels(data):
+# How many label calls add_labels makes, one per community with children
+def label_calls(data):
+	if "children" in data.keys():
+		return 1 + sum(label_calls(c) for c in data["children"])
+	else:
+		return 0
+
+
+def _add_labels(data, progress):
 	if "children" in data.keys():
 		for child in data["children"]:
-			_add_labels(child)
+			_add_labels(child, progress)
 		inner = [c["label"] for c in data["children"]]
 		data["label"] = _label_entities([c["label"] for c in data["children"]])
+		if progress is not None:
+			progress()
 	else:
 		data["label"] = data["id"]
 
 
 # Generates labels for a collection of communities 
 # Estimate the cost with communities_label_count
-def add_labels(data):
-	with dspy.context(lm=dspy.LM(label_model)):
-		return _add_labels(data)
+# progress is called after each label call
+def add_labels(data, progress=None):
+	with dspy.context(lm=dspy.LM(label_model)), ledger.tagged(run="labels"):
+		return _add_labels(data, progress)
 
 
 def _dfs_node_addition(graph, data, parent):
@@ -0,0 +1,140 @@
+from dspy.utils.callback import BaseCallback, ACTIVE_CALL_ID
+from contextlib import contextmanager
+from contextvars import ContextVar
+from metrics import lm_usage
+import threading
+import dspy
+import json
+import time
+import os
+
+# An append-only log of every LM call, one json object per line:
+#   start       when the call started (unix seconds)
+#   latency     seconds it took
+#   model
+#   prompt_tokens, completion_tokens (None when the provider doesn't say)
+#   attempt     1 for a module's first LM call, more when its output couldn't
+#               be parsed and the adapter asked again
+#   module      the signature (or module) that made the call
+#   error       the exception, if the call failed
+# plus the tags of whatever was running, like run (process, streaming, query,
+# labels), checkpoint and stage
+# Cached responses (llm_cache) aren't calls and aren't logged
+default_path = os.getenv("LLM_LEDGER", "graphs/llm_ledger.jsonl")
+# process.py and streaming.py keep theirs with the chunks
+file_name = "llm_ledger.jsonl"
+
+_tags = ContextVar("ledger_tags", default={})
+
+
+# Adds tags to the entries of the LM calls made inside
+@contextmanager
+def tagged(**tags):
+	token = _tags.set({**_tags.get(), **tags})
+	try:
+		yield
+	finally:
+		_tags.reset(token)
+
+
+class Ledger(BaseCallback):
+	def __init__(self, path=default_path, run=None):
+		self.path = path
+		self.run = run
+		# call_id -> (module name, LM calls made so far) for running modules
+		self.modules = {}
+		# call_id -> (module call_id, LM, tags, wall start, start) for running LM calls
+		self.calls = {}
+		# LM calls can come from worker threads
+		self.lock = threading.Lock()
+
+		# Opened on the first entry, so a run that makes no LM calls leaves no
+		# file behind (process_input.sh counts the output directory's files)
+		self.file = None
+
+	def on_module_start(self, call_id, instance, inputs):
+		signature = getattr(instance, "signature", None)
+		name = getattr(signature, "__name__", None) or type(instance).__name__
+		with self.lock:
+			self.modules[call_id] = (name, 0)
+
+	def on_module_end(self, call_id, outputs, exception=None):
+		with self.lock:
+			self.modules.pop(call_id, None)
+
+	def on_lm_start(self, call_id, instance, inputs):
+		# The LM call's parent is still the active call here
+		parent = ACTIVE_CALL_ID.get()
+		with self.lock:
+			self.calls[call_id] = (parent, instance, _tags.get(), time.time(), time.perf_counter())
+
+	def on_lm_end(self, call_id, outputs, exception=None):
+		end = time.perf_counter()
+		with self.lock:
+			call = self.calls.pop(call_id, None)
+			if call is None:
+				return
+			parent, instance, tags, wall_start, start = call
+			module, attempt = self.modules.get(parent, (None, 0))
+			attempt += 1
+			if parent in self.modules:
+				self.modules[parent] = (module, attempt)
+
+		usage = (lm_usage(instance, outputs) if exception is None else None) or {}
+		entry = {
+			"start": wall_start,
+			"latency": end - start,
+			"model": getattr(instance, "model", None),
+			"prompt_tokens": usage.get("prompt_tokens"),
+			"completion_tokens": usage.get("completion_tokens"),
+			"attempt": attempt,
+			"module": module,
+			"run": self.run,
+			**tags,
+		}
+		if exception is not None:
+			entry["error"] = repr(exception)
+		self.write(entry)
+
+	def write(self, entry):
+		line = json.dumps(entry, default=str) + "\n"
+		with self.lock:
+			if self.file is None:
+				if os.path.dirname(self.path):
+					os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				self.file = open(self.path, "a", encoding="utf-8")
+			self.file.write(line)
+			self.file.flush()
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+
+_ledger = None
+
+
+# Logs every dspy LM call (ours, kg-gen's, labels') to path, alongside any
+# callbacks that are already configured
+# run is the default run tag
+def enable(path=default_path, run=None):
+	global _ledger
+	if _ledger is not None:
+		return _ledger
+	_ledger = Ledger(path, run)
+	dspy.configure(callbacks=[*(dspy.settings.callbacks or []), _ledger])
+	return _ledger
+
+
+# Every entry of a ledger, skipping any line cut off by a crash
+def read(path):
+	entries = []
+	with open(path, encoding="utf-8") as f:
+		for line in f:
+			try:
+				entries.append(json.loads(line))
+			except json.JSONDecodeError:
+				continue
+	return entries
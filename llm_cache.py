@@ -0,0 +1,159 @@
+import dspy
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+default_path = os.getenv("LLM_CACHE", "graphs/llm_cache.sqlite")
+default_size = int(os.getenv("LLM_CACHE_SIZE", str(1 << 30)))
+
+
+# Disk-backed store of LM outputs, least recently used entries are evicted 
+# once the stored outputs exceed max_bytes
+class ResponseCache:
+	def __init__(self, path=default_path, max_bytes=default_size):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		# LM calls can come from worker threads
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("""
+			CREATE TABLE IF NOT EXISTS responses (
+				key TEXT PRIMARY KEY,
+				model TEXT NOT NULL,
+				signature TEXT,
+				outputs TEXT NOT NULL,
+				size INTEGER NOT NULL,
+				accessed REAL NOT NULL
+			)
+		""")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+		self.connection.commit()
+		self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+	def get(self, key):
+		with self.lock:
+			row = self.connection.execute("SELECT outputs FROM responses WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+			self.connection.commit()
+			return json.loads(row[0])
+
+	def put(self, key, model, signature, outputs):
+		try:
+			outputs = json.dumps(outputs)
+		except TypeError:
+			# Not worth caching things we can't get back out
+			return
+		with self.lock:
+			old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+			if old is not None:
+				self.size -= old[0]
+			self.connection.execute(
+				"INSERT OR REPLACE INTO responses (key, model, signature, outputs, size, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+				(key, model, signature, outputs, len(outputs), time.time()),
+			)
+			self.size += len(outputs)
+			self._evict()
+			self.connection.commit()
+
+	# Drops the oldest entries until we're comfortably below the limit
+	def _evict(self):
+		if self.size <= self.max_bytes:
+			return
+		target = self.max_bytes * 0.9
+		cursor = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed")
+		evicted = []
+		for key, size in cursor:
+			if self.size <= target:
+				break
+			evicted.append((key,))
+			self.size -= size
+		self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+		self.evictions += len(evicted)
+
+	def stats(self):
+		with self.lock:
+			entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+		lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+			"evictions": self.evictions,
+			"entries": entries,
+			"bytes": self.size,
+		}
+
+
+_cache = None
+
+
+# Requests are keyed by model, the signature's instructions (the system 
+# message), and everything else that goes into the request
+def request_key(lm, prompt, messages, kwargs):
+	signature = None
+	if messages and messages[0].get("role") == "system":
+		signature = hashlib.sha256(str(messages[0]["content"]).encode()).hexdigest()
+	request = json.dumps({
+		"model": lm.model,
+		"model_type": lm.model_type,
+		"kwargs": {**lm.kwargs, **kwargs},
+		"prompt": prompt,
+		"messages": messages,
+	}, sort_keys=True, default=str)
+	return hashlib.sha256(request.encode()).hexdigest(), signature
+
+
+def _cached_call(call):
+	@functools.wraps(call)
+	def cached_call(self, prompt=None, messages=None, **kwargs):
+		if _cache is None:
+			return call(self, prompt=prompt, messages=messages, **kwargs)
+		key, signature = request_key(self, prompt, messages, kwargs)
+		outputs = _cache.get(key)
+		if outputs is None:
+			outputs = call(self, prompt=prompt, messages=messages, **kwargs)
+			_cache.put(key, self.model, signature, outputs)
+		return outputs
+	cached_call.response_cache = True
+	return cached_call
+
+
+# Routes every dspy.LM call (ours, kg-gen's, labels') through the cache 
+def enable(path=default_path, max_bytes=default_size):
+	global _cache
+	_cache = ResponseCache(path, max_bytes)
+	if not getattr(dspy.LM.__call__, "response_cache", False):
+		dspy.LM.__call__ = _cached_call(dspy.LM.__call__)
+	print(f"Caching LM responses in '{path}'")
+	return _cache
+
+
+def disable():
+	global _cache
+	_cache = None
+
+
+def stats():
+	if _cache is None:
+		return None
+	return _cache.stats()
+
+
+def print_stats():
+	if s := stats():
+		print(f"LM cache: {s["hits"]} hits, {s["misses"]} misses ({s["hit_rate"]*100:.1f}%), {s["entries"]} entries, {s["bytes"]/1e6:.1f}MB")
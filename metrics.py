@@ -0,0 +1,172 @@
+from dspy.utils.callback import BaseCallback
+import threading
+import math
+import time
+
+# Counters and histograms in the Prometheus text format, just enough for
+# query_server's /metrics without another dependency
+# Everything here is process-wide and safe to update from any thread
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _label_text(names, values, extra=()):
+	pairs = [*zip(names, values), *extra]
+	if len(pairs) == 0:
+		return ""
+	escaped = [(n, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for n, v in pairs]
+	return "{" + ",".join(f"{n}=\"{v}\"" for n, v in escaped) + "}"
+
+
+def _number(value):
+	if value == math.inf:
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+	type = "counter"
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.values = {}
+		_registry.append(self)
+
+	def inc(self, amount=1, **labels):
+		key = tuple(labels[l] for l in self.labels)
+		with _lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def samples(self):
+		for key, value in sorted(self.values.items()):
+			yield self.name, _label_text(self.labels, key), value
+
+
+class Histogram:
+	type = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=default_buckets):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.buckets = tuple(buckets) + (math.inf,)
+		# labels -> ([count per bucket], sum, count)
+		self.values = {}
+		_registry.append(self)
+
+	def observe(self, value, **labels):
+		key = tuple(labels[l] for l in self.labels)
+		with _lock:
+			counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+			self.values[key] = (counts, total + value, count + 1)
+
+	def samples(self):
+		for key, (counts, total, count) in sorted(self.values.items()):
+			for bound, bucket_count in zip(self.buckets, counts):
+				yield f"{self.name}_bucket", _label_text(self.labels, key, [("le", _number(bound))]), bucket_count
+			yield f"{self.name}_sum", _label_text(self.labels, key), total
+			yield f"{self.name}_count", _label_text(self.labels, key), count
+
+
+# A gauge read when the metrics are rendered
+# read returns a value, or {label values: value}
+class Gauge:
+	type = "gauge"
+
+	def __init__(self, name, help, read, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.read = read
+		_registry.append(self)
+
+	def samples(self):
+		values = self.read()
+		if not isinstance(values, dict):
+			values = {(): values}
+		for key, value in sorted(values.items()):
+			if value is not None:
+				yield self.name, _label_text(self.labels, key), value
+
+
+def render():
+	lines = []
+	with _lock:
+		metrics = list(_registry)
+	for metric in metrics:
+		lines.append(f"# HELP {metric.name} {metric.help}")
+		lines.append(f"# TYPE {metric.name} {metric.type}")
+		# Gauges read other things' state, so they aren't read under the lock
+		if isinstance(metric, Gauge):
+			samples = list(metric.samples())
+		else:
+			with _lock:
+				samples = list(metric.samples())
+		for name, labels, value in samples:
+			lines.append(f"{name}{labels} {_number(value)}")
+	return "\n".join(lines) + "\n"
+
+
+# Shared by query.py and the server
+
+graph_round_trips = Counter(
+	"graph_db_round_trips_total",
+	"Queries sent to the graph database",
+	["backend"],
+)
+lm_calls = Counter(
+	"lm_calls_total",
+	"LM calls made (cached responses aren't calls)",
+	["model", "outcome"],
+)
+lm_tokens = Counter(
+	"lm_tokens_total",
+	"Tokens used by LM calls",
+	["model", "kind"],
+)
+lm_seconds = Histogram(
+	"lm_call_seconds",
+	"Time taken by LM calls",
+	["model"],
+)
+
+
+# Counts every dspy LM call and its token usage
+# Add it with dspy.configure(callbacks=[...])
+class LMMetrics(BaseCallback):
+	def __init__(self):
+		self.calls = {}
+		self.lock = threading.Lock()
+
+	def on_lm_start(self, call_id, instance, inputs):
+		with self.lock:
+			self.calls[call_id] = (instance, time.perf_counter())
+
+	def on_lm_end(self, call_id, outputs, exception=None):
+		with self.lock:
+			instance, start = self.calls.pop(call_id, (None, None))
+		if instance is None:
+			return
+		model = getattr(instance, "model", "unknown")
+		lm_calls.inc(model=model, outcome="error" if exception is not None else "ok")
+		lm_seconds.observe(time.perf_counter() - start, model=model)
+		if exception is None and (usage := lm_usage(instance, outputs)):
+			for kind in ("prompt_tokens", "completion_tokens"):
+				lm_tokens.inc(usage.get(kind) or 0, model=model, kind=kind.removesuffix("_tokens"))
+
+
+# The usage of the LM's history entry with these outputs
+# Other threads may have used the same LM since, so look back a little
+def lm_usage(lm, outputs):
+	for entry in reversed(getattr(lm, "history", [])[-16:]):
+		if entry.get("outputs") == outputs:
+			return entry.get("usage")
+	return None
@@ -0,0 +1,49 @@
+import storage
+import argparse
+import os
+
+
+def main():
+	"""
+	Moves a directory of chunk-*.json checkpoints into a single sqlite 
+	checkpoint file in the same directory. 
+	The json files are left alone unless --remove is given. 
+	"""
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir")
+	parser.add_argument("--remove", action="store_true", help="delete the json files once copied")
+	args = parser.parse_args()
+
+	source = storage.DirectoryChunkStore(args.dir)
+	destination = storage.SqliteChunkStore(args.dir)
+
+	checkpoints = source.checkpoints()
+	print(f"Copying {len(checkpoints)} checkpoints")
+	for i, checkpoint in enumerate(checkpoints):
+		if checkpoint in destination:
+			continue
+		if (i+1) % 100 == 0:
+			print(f"Copy checkpoint {i+1}/{len(checkpoints)}")
+		chunk = source.load(checkpoint)
+		# Older checkpoints might not agree with their file name
+		chunk["tags"]["checkpoint"] = checkpoint
+		destination.save(chunk)
+
+	missing = [c for c in checkpoints if c not in destination]
+	if len(missing) > 0:
+		print(f"{len(missing)} checkpoints were not copied!")
+		exit(1)
+	print(f"Sqlite store has {len(destination)} checkpoints")
+
+	if args.remove:
+		print("Removing json checkpoints")
+		for checkpoint in checkpoints:
+			os.remove(source.path(checkpoint))
+	
+	destination.close()
+	print("Done!")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,7 @@
 from kg_gen import KGGen
 import storage
+import llm_cache
+import argparse
 import os
 
 model = "ollama/phi4"
@@ -8,6 +10,13 @@ output_dir = "kg-gen-repo/MINE/KGs"
 
 
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--llmcache", nargs="?", const=llm_cache.default_path, help="cache LM responses (in this file)")
+	args = parser.parse_args()
+
+	if args.llmcache:
+		llm_cache.enable(args.llmcache)
+
 	os.makedirs(output_dir, exist_ok=True)
 
 	kg = KGGen(
@@ -29,6 +38,7 @@ def main():
 		)
 		storage.save_graph(graph, output_file)
 	
+	llm_cache.print_stats()
 	print("Done!")
 
 
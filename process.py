@@ -1,16 +1,28 @@
 from kg_gen import KGGen, Graph
 from pypdf import PdfReader
 import storage
+from compact_graph import CompactGraph
+import csr_graph
+import entity_index
+import text_store
+import llm_cache
+import ledger
 import argparse
 import os
 import time
 from neo4j import GraphDatabase
+from psycopg import sql
 import dspy
-from dspy.utils.callback import BaseCallback
 from pprint import pprint
 import age
 import json
 import hashlib
+import queue
+import threading
+import bisect
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 
 db_url = os.getenv("DB_HOST", "neo4j://localhost:7687")
@@ -19,66 +31,116 @@ db_pass = os.getenv("DB_PASSWORD", "no_password")
 db_base = os.getenv("DB_DATABASE", "neo4j")
 
 processing_model = os.getenv("PROCESSING_MODEL", "ollama/phi4")
+page_cache = os.getenv("PAGE_CACHE", "graphs/page_cache")
 
 
-def get_pdf_pages_text(path):
+def _file_hash(path):
+	h = hashlib.md5()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(1 << 20), b""):
+			h.update(block)
+	return h.hexdigest()
+
+
+def _page_cache_path(cache_dir, page_i):
+	return f"{cache_dir}/page-{page_i}.txt"
+
+
+# Runs in a worker process, pdf readers can't be shared between processes 
+def _extract_pages(path, page_numbers, cache_dir):
 	reader = PdfReader(path)
-	return [page.extract_text() for page in reader.pages]
+	for page_i in page_numbers:
+		storage.save_text(reader.pages[page_i].extract_text(), _page_cache_path(cache_dir, page_i))
+
+
+# Yields the text of each page
+# Page texts are cached by the pdf's hash so that reruns (and requeues) skip 
+# extraction, missing pages are extracted in parallel
+def get_pdf_pages_text(path, cache_dir=page_cache, workers=None, batch_size=16):
+	cache_dir = f"{cache_dir}/{_file_hash(path)}"
+	n_pages = len(PdfReader(path).pages)
+	missing = [i for i in range(n_pages) if not os.path.isfile(_page_cache_path(cache_dir, i))]
+
+	if len(missing) > 0:
+		print(f"Extracting text from {len(missing)}/{n_pages} pages")
+		extract_st = time.time()
+		batches = [missing[i:(i+batch_size)] for i in range(0, len(missing), batch_size)]
+		if workers == 1 or len(batches) == 1:
+			for batch in batches:
+				_extract_pages(path, batch, cache_dir)
+		else:
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				for future in as_completed([pool.submit(_extract_pages, path, batch, cache_dir) for batch in batches]):
+					future.result()
+		print(f"\tExtracted in {time.time() - extract_st:.2f}s")
+	else:
+		print(f"Using cached text for {n_pages} pages")
+
+	for i in range(n_pages):
+		with open(_page_cache_path(cache_dir, i), encoding="utf-8") as f:
+			yield f.read()
 
 
-# Creates collections of words, returns them and the page range they were pulled from
+# Creates collections of words, yields them and the page range they were pulled from
+# Pages are read lazily, only the words of the current chunk are kept around 
 def make_pages_chunks(pages, chunk_size=100, spillover=10):
-	# The number of words passed at the end of a page
+	pages = iter(pages)
+	# The number of words passed at the end of each page read so far
 	page_position = []
-	cur_count = 0
-	for i, page_text in enumerate(pages):
-		words = page_text.split()
-		cur_count += len(words)
-		page_position.append(cur_count)
-
-	# Collect (chunk, (st, en))
-	chunks_sources = []
-	words = [word for page in pages for word in page.split()]
+	n_words = 0
+	# Words from index buffer_st onwards
+	buffer = deque()
+	buffer_st = 0
+
+	# Reads pages until word_i's page is known (or we run out of pages)
+	def read_past(word_i):
+		nonlocal n_words
+		while n_words <= word_i:
+			page_text = next(pages, None)
+			if page_text is None:
+				break
+			words = page_text.split()
+			buffer.extend(words)
+			n_words += len(words)
+			page_position.append(n_words)
+
+	# The first page ending after word_i
+	def find_page(word_i):
+		return bisect.bisect_right(page_position, word_i)
+
 	i = 0
 	while True:
-		segment = words[i:(i+chunk_size)]
-
-		def find_page(word_i):
-			page = 0
-			while page_position[page] <= word_i:
-				page += 1
-				if page >= len(page_position):
-					break
-			return page
+		read_past(i + chunk_size)
+		for _ in range(i - buffer_st):
+			buffer.popleft()
+		buffer_st = i
+		segment = list(itertools.islice(buffer, chunk_size))
 
 		st = find_page(i) 
 		en = find_page(i + len(segment))
 
 		# Splitting by words does lose whitespace information
 		# Impact unknown 
-		chunks_sources.append((
+		yield (
 			" ".join(segment), 
 			(st, en)
-		))
+		)
 
 		i += len(segment)
-		if i < len(words):
+		if i < n_words:
 			i -= spillover
 		else:
 			break
 
-	return chunks_sources
-
 
-def pdf_chunks(path):
+def pdf_chunks(path, chunk_size=100, spillover=10, cache_dir=page_cache, workers=None):
 	print(f"Reading pdf from {path}")
-	pages = get_pdf_pages_text(path)
-	chunks = make_pages_chunks(pages)
-	print(f"Made {len(chunks)} chunks")
-	formatted_chunks = []
+	pages = get_pdf_pages_text(path, cache_dir, workers)
+	chunks = make_pages_chunks(pages, chunk_size, spillover)
+	i = -1
 	for i, (text, (st, en)) in enumerate(chunks):
 		text_hash = hashlib.md5(text.encode()).hexdigest()
-		formatted_chunks.append({
+		yield {
 			"text": text,
 			"hash": text_hash, # Used for stored filename
 			# These are included in the graph as relationship properties
@@ -90,131 +152,231 @@ def pdf_chunks(path):
 				"checkpoint": f"chunk-{text_hash}.json",
 				# "audio_timestamp": idk,
 			}	
-		})
-	return formatted_chunks
+		}
+	print(f"Made {i+1} chunks")
+
+
+_aggregate_kg = None
+
+
+def _init_aggregate_worker(model):
+	global _aggregate_kg
+	_aggregate_kg = KGGen(model=model)
+
+
+# Runs in a worker process, loads its own chunks so they aren't pickled 
+# Returns the aggregated graph and the chunks it counts as included
+def _aggregate_checkpoints(chunks_dir, backend, checkpoints):
+	store = storage.open_chunk_store(chunks_dir, backend)
+	graph = CompactGraph()
+	included = []
+	for checkpoint in checkpoints:
+		chunk = store.load(checkpoint)
+		graph.add_chunk(chunk)
+		if "errors" not in chunk:
+			included.append(checkpoint)
+	store.close()
+	return _aggregate_kg.aggregate([graph.to_graph()]), included
+
+
+def _aggregate_graphs(graphs):
+	return _aggregate_kg.aggregate(graphs)
+
+
+# Aggregates groups of fan_in chunks in a process pool, then groups of those 
+# results, and so on until there is one graph
+# Only the results of the current level are held by this process
+def aggregate_tree(chunks_dir, store, checkpoints, fan_in=64, workers=None):
+	def groups(items):
+		return [items[i:(i+fan_in)] for i in range(0, len(items), fan_in)]
+
+	with ProcessPoolExecutor(
+		max_workers=workers, 
+		initializer=_init_aggregate_worker, 
+		initargs=(processing_model,),
+	) as pool:
+		level = []
+		included = []
+		for graph, group_included in pool.map(
+			_aggregate_checkpoints, 
+			itertools.repeat(chunks_dir), 
+			itertools.repeat(store.backend), 
+			groups(checkpoints),
+		):
+			level.append(graph)
+			included.extend(group_included)
+		
+		depth = 1
+		while len(level) > 1:
+			print(f"\tLevel {depth}: {len(level)} partial graphs")
+			level = list(pool.map(_aggregate_graphs, groups(level)))
+			depth += 1
+	
+	return level[0], included
 
 
-# Looks for files with names in the chunk format, aggregates them, saves the 
+# Loads the chunks in a checkpoint store, aggregates them, saves the 
 # aggregated knowledge graph 
-def aggregate_chunks(kg, chunks_dir):
+# The aggregation records which chunks it includes, so with update it can
+# fold in only the chunks that were added since
+# With fan_in, large chunk sets are aggregated with aggregate_tree
+def aggregate_chunks(kg, chunks_dir, store, update=False, fan_in=None, workers=None):
 	aggregation_fname = chunks_dir + "/aggregated.json"
+	graphs = []
+	included = set()
+	previous = None
 	if os.path.isfile(aggregation_fname):
-		print("Aggregation file already exists!")
+		if not update:
+			print("Aggregation file already exists!")
+			return
+		previous = storage.load_json(aggregation_fname)
+		if "chunks" not in previous:
+			print("Aggregation file does not list its chunks, it can't be updated!")
+			return
+		graphs.append(storage.graph_from_json(previous))
+		included = set(previous["chunks"])
+		print(f"Updating aggregation of {len(included)} chunks")
+
+	new_checkpoints = [c for c in store.checkpoints() if c not in included]
+	# Without a previous aggregation there is nothing to be up to date with
+	if previous is not None and len(new_checkpoints) == 0:
+		print("Aggregation is up to date")
 		return
 
-	graphs = []
-	for fname in os.listdir(chunks_dir):
-		if fname.startswith("chunk-"):
-			print(f"Loading chunk graph '{fname}'")
-			g = storage.load_chunk(chunks_dir + "/" + fname)["graph"]
-			graphs.append(g)
-
-	print(f"Aggregating {len(graphs)} graphs")
-
 	aggregate_st = time.time()
+	if fan_in and len(new_checkpoints) > fan_in:
+		print(f"Aggregating {len(new_checkpoints)} graphs in groups of {fan_in}")
+		graph, tree_included = aggregate_tree(chunks_dir, store, new_checkpoints, fan_in, workers)
+		graphs.append(graph)
+		included.update(tree_included)
+	else:
+		# Chunk graphs are interned as they load rather than all kept around
+		graph = CompactGraph()
+		for checkpoint in new_checkpoints:
+			print(f"Loading chunk graph '{checkpoint}'")
+			chunk = store.load(checkpoint)
+			graph.add_chunk(chunk)
+			# Error chunks might be reprocessed later, so don't count them
+			if "errors" not in chunk:
+				included.add(checkpoint)
+		graphs.append(graph.to_graph())
+
+	print(f"Aggregating {len(new_checkpoints)} graphs")
 	aggregated_graph = kg.aggregate(graphs)
 	aggregate_en = time.time()
 	aggregate_duration = aggregate_en - aggregate_st
 	print(f"\tAggregation processed in {aggregate_duration:.2f}s")
 
-	storage.save_graph(aggregated_graph, aggregation_fname)
+	data = storage.graph_to_json(aggregated_graph)
+	data["chunks"] = sorted(included)
+	storage.save_json(data, aggregation_fname)
 
 
-# Processes a document and outputs chunk and aggregated data
-# Does not aggregate them! 
-def process_chunks(chunks, output_path, kg, limit=None, partial=None, skip_errors=True, checkpointing=True):
-	n_processed = 0
-	for i, chunk in enumerate(chunks):
-		# Early termination option for testing
-		if limit and i >= int(limit):
-			print(f"Stopping chunk processing - limit {limit} chunks")
-			break
-		
-		if partial and n_processed >= int(partial):
-			print(f"Stopping chunk processing - partial {partial} chunks")
-			break
-
-		print(f"Process chunk {i+1}/{len(chunks)}")
-
-		# Check for checkpoint
-		chunk_output_path = output_path + "/" + chunk["tags"]["checkpoint"]
-		if checkpointing and os.path.isfile(chunk_output_path):
-			old_chunk = storage.load_json(chunk_output_path)
-			if old_chunk["text"] != chunk["text"]:
-				print("\tTODO: collision detection")
-				exit(1)
-			elif (not skip_errors) and "errors" in old_chunk.keys():
-				print("\tReprocess error chunk")
-			else:
-				print("\tSkipping due to checkpoint detection!")
-				continue
-
-		kgraph = None
-		errors = None
-		try:
-			generate_st = time.time()
+# Generates the knowledge graph for one chunk and saves it to its checkpoint
+def process_chunk(chunk, store, kg, skip_errors=True):
+	kgraph = None
+	errors = None
+	try:
+		generate_st = time.time()
+		with ledger.tagged(checkpoint=chunk["tags"]["checkpoint"]):
 			kgraph = kg.generate(
 				input_data=chunk["text"],
 			)
-			generate_en = time.time()
-			generate_duration = generate_en - generate_st
-			# Timing output doesn't currently use chunking
-			# Could append to a json file in the future 
-			print(f"\tChunk processed in {generate_duration:.2f}s")
-			chunk["time"] = generate_duration
-			chunk["graph"] = kgraph
-		except Exception as e:
-			print(f"Generic error ({type(e)})")
-			print("DSPY history:")
-			dspy.inspect_history(n=1)
-			if skip_errors:
-				print(str(e))
-			else:
-				raise e
-			print("\tError during kg-gen call, using dummy graph")
-			chunk["errors"] = str(e)
-			chunk["graph"] = Graph(
-				entities = set({}),
-				relations = set({}),
-				edges = set({}),
-			)
+		generate_en = time.time()
+		generate_duration = generate_en - generate_st
+		# Each LM call is timed in the ledger, see process_stats.py
+		print(f"\tChunk {chunk["tags"]["chunk_i"]+1} processed in {generate_duration:.2f}s")
+		chunk["time"] = generate_duration
+		chunk["graph"] = kgraph
+	except Exception as e:
+		print(f"Generic error ({type(e)})")
+		print("DSPY history:")
+		dspy.inspect_history(n=1)
+		if skip_errors:
+			print(str(e))
+		else:
+			raise e
+		print("\tError during kg-gen call, using dummy graph")
+		chunk["errors"] = str(e)
+		chunk["graph"] = Graph(
+			entities = set({}),
+			relations = set({}),
+			edges = set({}),
+		)
 
-		print(f"\tSaving as '{chunk_output_path}'")
-		storage.save_chunk(chunk, chunk_output_path)
-		n_processed += 1
+	print(f"\tSaving as '{chunk["tags"]["checkpoint"]}'")
+	store.save(chunk)
 
 
-# Dict of relation -> [references]
-def make_relationship_references(chunks):
-	relation_sources = {}
-	for chunk in chunks:
-		for relation in chunk["graph"].relations:
-			if relation in relation_sources:
-				relation_sources[relation].append(chunk["tags"])
-			else:
-				relation_sources[relation] = [chunk["tags"]]
-	return relation_sources
+# Processes a document and outputs chunk and aggregated data
+# Does not aggregate them! 
+# With more than one worker, chunks are generated concurrently (useful for 
+# hosted models, probably not for ollama)
+def process_chunks(chunks, store, kg, limit=None, partial=None, skip_errors=True, checkpointing=True, workers=1):
+	n_processed = 0
+	pool = None
+	pending = set()
+	# Checkpoints generated (or being generated) in this run, so repeated text
+	# is only generated once even when its first occurrence hasn't saved yet
+	submitted = set()
+	if workers > 1:
+		pool = ThreadPoolExecutor(max_workers=workers)
+
+	try:
+		for i, chunk in enumerate(chunks):
+			# Early termination option for testing
+			if limit and i >= int(limit):
+				print(f"Stopping chunk processing - limit {limit} chunks")
+				break
+			
+			if partial and n_processed >= int(partial):
+				print(f"Stopping chunk processing - partial {partial} chunks")
+				break
+
+			print(f"Process chunk {i+1}")
+
+			# Check for checkpoint
+			checkpoint = storage.resolve_checkpoint(store, chunk)
+			if checkpointing and checkpoint in submitted:
+				print("\tSkipping, the same chunk was already processed in this run")
+				continue
+			if checkpointing and checkpoint in store:
+				if (not skip_errors) and "errors" in store.get(checkpoint).keys():
+					print("\tReprocess error chunk")
+				else:
+					print("\tSkipping due to checkpoint detection!")
+					continue
+
+			n_processed += 1
+			submitted.add(checkpoint)
+			if pool is None:
+				process_chunk(chunk, store, kg, skip_errors)
+				continue
 
+			# Keep the queue short so that limits and errors take effect promptly
+			if len(pending) >= workers:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					future.result()
+			pending.add(pool.submit(process_chunk, chunk, store, kg, skip_errors))
 
-# Dict of entity -> [references]
-def make_entity_references(chunks):
-	entity_sources = {}
-	for chunk in chunks:
-		for entity in chunk["graph"].entities:
-			if entity in entity_sources:
-				entity_sources[entity].append(chunk["tags"])
-			else:
-				entity_sources[entity] = [chunk["tags"]]
-	return entity_sources
+		for future in as_completed(pending):
+			future.result()
+	finally:
+		if pool is not None:
+			# Only reached early if a chunk raised, in which case we should stop
+			pool.shutdown(cancel_futures=True)
 
 
+# Entities and relationships are References from compact_graph, which act 
+# like dicts of entity -> tags json and (a, relation, b) -> tags json
 def write_graph_to_database(entities, relationships, driver):
 	for i, (entity, tags) in enumerate(entities.items()):
 		print(f"Write entity {i+1}/{len(entities)}")
 		driver.execute_query(
 			"CREATE (:Entity {id: $id, tags: $tags})",
 			id=entity,
-			tags=json.dumps(tags),
+			tags=tags,
 			database_=db_base,
 		)
 	
@@ -227,18 +389,64 @@ def write_graph_to_database(entities, relationships, driver):
 			f"CREATE (a)-[:{relation} {{ tags: $tags }}]->(b)",
 			id_a=a,
 			id_b=b,
-			tags=json.dumps(tags),
+			tags=tags,
 			relation=relation,
 			database_=db_base,
 		)
 
 
+# Like write_graph_to_database, but sends rows as lists of parameters 
+# One transaction per batch, one statement per relationship type 
+def write_graph_to_database_bulk(entities, relationships, driver, batch_size=1000):
+	upload_st = time.time()
+	n_rows = 0
+
+	# Without this every MATCH would be a label scan
+	driver.execute_query(
+		"CREATE INDEX entity_id IF NOT EXISTS FOR (e:Entity) ON (e.id)",
+		database_=db_base,
+	)
+
+	def write_batch(tx, statement, rows):
+		tx.run(statement, rows=rows).consume()
+
+	with driver.session(database=db_base) as session:
+		for batch in itertools.batched(entities.items(), batch_size):
+			session.execute_write(
+				write_batch,
+				"UNWIND $rows AS row CREATE (:Entity {id: row.id, tags: row.tags})",
+				[{"id": entity, "tags": tags} for entity, tags in batch],
+			)
+			n_rows += len(batch)
+			print(f"Wrote {n_rows}/{len(entities)} entities")
+
+		# Relationship types can't be parameters, so group by type
+		n_relations = 0
+		for r, group in relationships.by_relation().items():
+			relation = storage.to_neo4j_repr(r)
+			for batch in itertools.batched(group.items(), batch_size):
+				session.execute_write(
+					write_batch,
+					"UNWIND $rows AS row " + 
+					"MATCH (a:Entity {id: row.id_a}) " +
+					"MATCH (b:Entity {id: row.id_b}) " + 
+					f"CREATE (a)-[:{relation} {{ tags: row.tags }}]->(b)",
+					[{"id_a": a, "id_b": b, "tags": tags} for (a, _, b), tags in batch],
+				)
+				n_relations += len(batch)
+			print(f"Wrote {n_relations}/{len(relationships)} relations ({relation})")
+		n_rows += n_relations
+
+	upload_duration = time.time() - upload_st
+	print(f"\tUploaded {n_rows} rows in {upload_duration:.2f}s ({n_rows / max(upload_duration, 1e-9):.0f} rows/s)")
+
+
 def write_graph_to_database_psql(entities, relationships, ag):
 	for i, (entity, tags) in enumerate(entities.items()):
 		print(f"Write entity {i+1}/{len(entities)}")
 		ag.execCypher("""
 			CREATE (:Entity {id: %s, tags: %s})
-		""", params=(storage.to_neo4j_repr(entity), json.dumps(tags)))
+		""", params=(storage.to_neo4j_repr(entity), tags))
 	
 	for i, ((a, r, b), tags) in enumerate(relationships.items()):
 		print(f"Write relation {i+1}/{len(relationships)} ({a} ~ {r} ~ {b})")
@@ -249,7 +457,341 @@ def write_graph_to_database_psql(entities, relationships, ag):
 			MATCH (a:Entity {{id: %s}})
 			MATCH (b:Entity {{id: %s}})
 			CREATE (a)-[:{relation} {{ tags: %s }}]->(b)
-		""", params=(storage.to_neo4j_repr(a), storage.to_neo4j_repr(b), json.dumps(tags)))
+		""", params=(storage.to_neo4j_repr(a), storage.to_neo4j_repr(b), tags))
+
+
+# Reads chunks in a background thread so that loading and parsing checkpoints 
+# overlaps with whatever the consumer is doing
+def prefetch_chunks(chunks, buffer_size=256):
+	buffer = queue.Queue(maxsize=buffer_size)
+	done = object()
+
+	def read():
+		try:
+			for chunk in chunks:
+				buffer.put(chunk)
+		except Exception as e:
+			buffer.put(e)
+		buffer.put(done)
+
+	threading.Thread(target=read, daemon=True).start()
+	while (chunk := buffer.get()) is not done:
+		if isinstance(chunk, Exception):
+			raise chunk
+		yield chunk
+
+
+# Uploads chunks as they are read rather than after building the references
+# Rows are MERGEd and tags appended to, which ends up with the same tags as 
+# write_graph_to_database would write
+def stream_graph_to_database(chunks, driver, batch_size=1000):
+	upload_st = time.time()
+	n_chunks = 0
+	n_rows = 0
+
+	driver.execute_query(
+		"CREATE INDEX entity_id IF NOT EXISTS FOR (e:Entity) ON (e.id)",
+		database_=db_base,
+	)
+
+	# Tags are json lists, so appending is joining the lists' contents
+	append_tags = """
+		CASE WHEN {0}.tags IS NULL THEN row.tags 
+		ELSE left({0}.tags, size({0}.tags) - 1) + ", " + substring(row.tags, 1) END
+	"""
+
+	def write_batch(tx, statement, rows):
+		tx.run(statement, rows=rows).consume()
+
+	def flush(session, graph):
+		session.execute_write(
+			write_batch,
+			"UNWIND $rows AS row " + 
+			"MERGE (e:Entity {id: row.id}) " + 
+			f"SET e.tags = {append_tags.format("e")}",
+			[{"id": entity, "tags": tags} for entity, tags in graph.entity_references().items()],
+		)
+		for r, group in graph.relationship_references().by_relation().items():
+			relation = storage.to_neo4j_repr(r)
+			# An endpoint might only turn up as an entity in a later chunk
+			session.execute_write(
+				write_batch,
+				"UNWIND $rows AS row " + 
+				"MERGE (a:Entity {id: row.id_a}) " +
+				"MERGE (b:Entity {id: row.id_b}) " + 
+				f"MERGE (a)-[r:{relation}]->(b) " + 
+				f"SET r.tags = {append_tags.format("r")}",
+				[{"id_a": a, "id_b": b, "tags": tags} for (a, _, b), tags in group.items()],
+			)
+
+	with driver.session(database=db_base) as session:
+		graph = CompactGraph()
+		for chunk in chunks:
+			graph.add_chunk(chunk)
+			n_chunks += 1
+			n_pending = len(graph.entities) + len(graph.edge_src)
+			if n_pending >= batch_size:
+				flush(session, graph)
+				n_rows += n_pending
+				print(f"Wrote {n_chunks} chunks ({n_rows} rows)")
+				graph = CompactGraph()
+		flush(session, graph)
+		n_rows += len(graph.entities) + len(graph.edge_src)
+
+	# Endpoints that never were entities, write_graph_to_database wouldn't 
+	# have written their relations either
+	driver.execute_query(
+		"MATCH (e:Entity) WHERE e.tags IS NULL DETACH DELETE e",
+		database_=db_base,
+	)
+
+	upload_duration = time.time() - upload_st
+	print(f"\tUploaded {n_chunks} chunks in {upload_duration:.2f}s ({n_rows / max(upload_duration, 1e-9):.0f} rows/s)")
+
+
+# Finds (or creates) an AGE label, returns its label id and sequence name
+def _age_label(ag, label, kind="v"):
+	cursor = ag.connection.cursor()
+	query = """
+		SELECT l.id, l.seq_name FROM ag_catalog.ag_label l
+		JOIN ag_catalog.ag_graph g ON l.graph = g.graphid
+		WHERE g.name = %s AND l.name = %s
+	"""
+	cursor.execute(query, (ag.graphName, label))
+	row = cursor.fetchone()
+	if row is None:
+		create = "create_vlabel" if kind == "v" else "create_elabel"
+		cursor.execute(f"SELECT ag_catalog.{create}(%s, %s)", (ag.graphName, label))
+		cursor.execute(query, (ag.graphName, label))
+		row = cursor.fetchone()
+	return row
+
+
+# Like write_graph_to_database_psql, but skips cypher and copies rows straight 
+# into AGE's label tables 
+# Vertex ids are reserved up front so that edges don't need to MATCH anything
+def write_graph_to_database_psql_bulk(entities, relationships, ag, batch_size=1000):
+	upload_st = time.time()
+	n_rows = 0
+	cursor = ag.connection.cursor()
+
+	label_id, seq_name = _age_label(ag, "Entity")
+	entity_table = sql.Identifier(ag.graphName, "Entity")
+	cursor.execute(
+		"SELECT ag_catalog._graphid(%s, nextval(%s))::text FROM generate_series(1, %s)", 
+		(label_id, f'"{ag.graphName}"."{seq_name}"', len(entities)),
+	)
+	vertex_ids = {entity: row[0] for entity, row in zip(entities.keys(), cursor.fetchall())}
+
+	# Relations may point to vertices that are already stored
+	missing = set(e for a, _, b in relationships.keys() for e in (a, b) if e not in vertex_ids)
+	if len(missing) > 0:
+		cursor.execute(sql.SQL("""
+			SELECT id::text, ag_catalog.agtype_access_operator(properties, '"id"'::agtype)::text FROM {}
+		""").format(entity_table))
+		stored_ids = {json.loads(id): graphid for graphid, id in cursor}
+		for e in missing:
+			if storage.to_neo4j_repr(e) in stored_ids:
+				vertex_ids[e] = stored_ids[storage.to_neo4j_repr(e)]
+
+	for batch in itertools.batched(entities.items(), batch_size):
+		with cursor.copy(sql.SQL("COPY {} (id, properties) FROM STDIN").format(entity_table)) as copy:
+			for entity, tags in batch:
+				copy.write_row((vertex_ids[entity], json.dumps({
+					"id": storage.to_neo4j_repr(entity),
+					"tags": tags,
+				})))
+		ag.commit()
+		n_rows += len(batch)
+		print(f"Wrote {n_rows}/{len(entities)} entities")
+
+	n_relations = 0
+	for r, group in relationships.by_relation().items():
+		relation = storage.to_neo4j_repr(r)
+		_age_label(ag, relation, kind="e")
+		relation_table = sql.Identifier(ag.graphName, relation)
+		# The cypher path would MATCH nothing for relations without both vertices
+		rows = ((a, b, tags) for (a, _, b), tags in group.items() if a in vertex_ids and b in vertex_ids)
+		for batch in itertools.batched(rows, batch_size):
+			# Edge ids come from the label table's default
+			with cursor.copy(sql.SQL("COPY {} (start_id, end_id, properties) FROM STDIN").format(relation_table)) as copy:
+				for a, b, tags in batch:
+					copy.write_row((vertex_ids[a], vertex_ids[b], json.dumps({
+						"tags": tags,
+					})))
+			ag.commit()
+			n_relations += len(batch)
+		print(f"Wrote {n_relations}/{len(relationships)} relations ({relation})")
+	n_rows += n_relations
+
+	upload_duration = time.time() - upload_st
+	print(f"\tUploaded {n_rows} rows in {upload_duration:.2f}s ({n_rows / max(upload_duration, 1e-9):.0f} rows/s)")
+
+
+# The chunks that a reference list points to 
+def _reference_checkpoints(tags):
+	if isinstance(tags, str):
+		try:
+			tags = json.loads(tags)
+		except ValueError:
+			return None
+	return sorted(t["checkpoint"] for t in tags)
+
+
+# Compares references with what is stored ({stored key: tags json})
+# key maps a reference key to its stored form 
+# Returns (new References, changed {stored key: tags json}, stale [stored key])
+def diff_references(references, stored, key):
+	graph = references.graph
+	keyed = {}
+	for i in references.ids:
+		sk = key(references.key(i))
+		if sk in keyed:
+			# Some keys are indistinguishable once stored
+			keyed[sk][1].extend(references.chunks[i])
+		else:
+			keyed[sk] = (i, list(references.chunks[i]))
+
+	new = []
+	changed = {}
+	for sk, (i, chunk_ids) in keyed.items():
+		if sk not in stored:
+			new.append(i)
+		elif graph.checkpoints(chunk_ids) != _reference_checkpoints(stored[sk]):
+			changed[sk] = graph.tags_json(chunk_ids)
+	stale = [sk for sk in stored.keys() if sk not in keyed]
+	return references.subset(new), changed, stale
+
+
+# Returns ({id: tags json}, {(a, relation, b): tags json}) as stored in neo4j
+def read_graph_from_database(driver):
+	records, _, _ = driver.execute_query(
+		"MATCH (e:Entity) RETURN e.id AS id, e.tags AS tags",
+		database_=db_base,
+	)
+	entities = {id: tags for id, tags in records}
+	records, _, _ = driver.execute_query(
+		"MATCH (a:Entity)-[r]->(b:Entity) RETURN a.id AS a, TYPE(r) AS r, b.id AS b, r.tags AS tags",
+		database_=db_base,
+	)
+	relationships = {(a, r, b): tags for a, r, b, tags in records}
+	return entities, relationships
+
+
+# Applies only the differences between the references and the database
+def update_graph_in_database(entities, relationships, driver, bulk=False, batch_size=1000):
+	stored_entities, stored_relationships = read_graph_from_database(driver)
+	new_entities, changed_entities, stale_entities = diff_references(
+		entities, stored_entities, lambda e: e,
+	)
+	new_relationships, changed_relationships, stale_relationships = diff_references(
+		relationships, stored_relationships, lambda k: (k[0], storage.to_neo4j_repr(k[1]), k[2]),
+	)
+	print(f"Entities: {len(new_entities)} new, {len(changed_entities)} changed, {len(stale_entities)} stale")
+	print(f"Relations: {len(new_relationships)} new, {len(changed_relationships)} changed, {len(stale_relationships)} stale")
+
+	def run_batches(tx, statement, rows):
+		for batch in itertools.batched(rows, batch_size):
+			tx.run(statement, rows=list(batch)).consume()
+
+	def by_relation(keys, tags=None):
+		rows = {}
+		for a, r, b in keys:
+			row = {"id_a": a, "id_b": b}
+			if tags is not None:
+				row["tags"] = tags[(a, r, b)]
+			rows.setdefault(r, []).append(row)
+		return rows
+
+	with driver.session(database=db_base) as session:
+		for relation, rows in by_relation(stale_relationships).items():
+			session.execute_write(
+				run_batches,
+				"UNWIND $rows AS row " + 
+				f"MATCH (:Entity {{id: row.id_a}})-[r:{relation}]->(:Entity {{id: row.id_b}}) " +
+				"DELETE r",
+				rows,
+			)
+		session.execute_write(
+			run_batches,
+			"UNWIND $rows AS row MATCH (e:Entity {id: row}) DETACH DELETE e",
+			stale_entities,
+		)
+		session.execute_write(
+			run_batches,
+			"UNWIND $rows AS row MATCH (e:Entity {id: row.id}) SET e.tags = row.tags",
+			[{"id": e, "tags": tags} for e, tags in changed_entities.items()],
+		)
+		for relation, rows in by_relation(changed_relationships.keys(), changed_relationships).items():
+			session.execute_write(
+				run_batches,
+				"UNWIND $rows AS row " + 
+				f"MATCH (:Entity {{id: row.id_a}})-[r:{relation}]->(:Entity {{id: row.id_b}}) " +
+				"SET r.tags = row.tags",
+				rows,
+			)
+
+	if bulk:
+		write_graph_to_database_bulk(new_entities, new_relationships, driver, batch_size)
+	else:
+		write_graph_to_database(new_entities, new_relationships, driver)
+
+
+# Returns ({id: tags json}, {(a, relation, b): tags json}) as stored in AGE
+# Everything is in its to_neo4j_repr form
+def read_graph_from_database_psql(ag):
+	cursor = ag.execCypher(
+		"MATCH (e:Entity) RETURN e.id, e.tags", 
+		cols=["id", "tags"],
+	)
+	entities = {id: tags for id, tags in cursor}
+	cursor = ag.execCypher(
+		"MATCH (a:Entity)-[r]->(b:Entity) RETURN a.id, label(r), b.id, r.tags", 
+		cols=["a", "r", "b", "tags"],
+	)
+	relationships = {(a, r, b): tags for a, r, b, tags in cursor}
+	return entities, relationships
+
+
+# Applies only the differences between the references and the database
+# Does not commit 
+def update_graph_in_database_psql(entities, relationships, ag, bulk=False, batch_size=1000):
+	stored_entities, stored_relationships = read_graph_from_database_psql(ag)
+	new_entities, changed_entities, stale_entities = diff_references(
+		entities, stored_entities, storage.to_neo4j_repr,
+	)
+	new_relationships, changed_relationships, stale_relationships = diff_references(
+		relationships, stored_relationships, lambda k: tuple(storage.to_neo4j_repr(v) for v in k),
+	)
+	print(f"Entities: {len(new_entities)} new, {len(changed_entities)} changed, {len(stale_entities)} stale")
+	print(f"Relations: {len(new_relationships)} new, {len(changed_relationships)} changed, {len(stale_relationships)} stale")
+
+	for a, relation, b in stale_relationships:
+		ag.execCypher(f"""
+			MATCH (:Entity {{id: %s}})-[r:{relation}]->(:Entity {{id: %s}})
+			DELETE r
+		""", params=(a, b))
+	for e in stale_entities:
+		ag.execCypher("""
+			MATCH (e:Entity {id: %s})
+			DETACH DELETE e
+		""", params=(e,))
+	for e, tags in changed_entities.items():
+		ag.execCypher("""
+			MATCH (e:Entity {id: %s})
+			SET e.tags = %s
+		""", params=(e, tags))
+	for (a, relation, b), tags in changed_relationships.items():
+		ag.execCypher(f"""
+			MATCH (:Entity {{id: %s}})-[r:{relation}]->(:Entity {{id: %s}})
+			SET r.tags = %s
+		""", params=(a, b, tags))
+
+	if bulk:
+		ag.commit()
+		write_graph_to_database_psql_bulk(new_entities, new_relationships, ag, batch_size)
+	else:
+		write_graph_to_database_psql(new_entities, new_relationships, ag)
 
 
 def main():
@@ -258,69 +800,130 @@ def main():
 	parser.add_argument("-o", "--output")
 	parser.add_argument("-a", "--aggregate", action="store_true")
 	parser.add_argument("-u", "--upload", action="store_true")
+	parser.add_argument("--update", action="store_true", help="add new chunks to an existing aggregation")
+	parser.add_argument("--aggregatefanin", type=int, help="aggregate in a process pool, n graphs at a time")
+	parser.add_argument("--aggregateworkers", type=int, help="processes used with --aggregatefanin")
 	parser.add_argument("--limit", help="only process up to n chunks")
 	parser.add_argument("--partial", help="process n unprocessed chunks and then exit")
 	parser.add_argument("--skiperrors", action="store_true")
 	parser.add_argument("--only", help="process only chunk i, then output dspy history")
 	parser.add_argument('--chunksize', default=100, type=int)
 	parser.add_argument('--chunkoverlap', default=10, type=int)
+	parser.add_argument("--pagecache", default=page_cache, help="directory for extracted page text")
+	parser.add_argument("--pageworkers", type=int, help="processes used for page text extraction")
 	parser.add_argument("--postgres", action="store_true")
+	parser.add_argument("--workers", default=1, type=int, help="generate up to n chunks concurrently")
+	parser.add_argument("--bulk", action="store_true", help="upload in batches rather than row by row")
+	parser.add_argument("--batchsize", default=1000, type=int, help="rows per batch for --bulk")
+	parser.add_argument("--incremental", action="store_true", help="upload only the difference from the stored graph")
+	parser.add_argument("--stream", action="store_true", help="upload to neo4j while reading checkpoints")
+	parser.add_argument("--csr", action="store_true", help="build the in-process csr graph used by query.py --local")
+	parser.add_argument("--entityindex", action="store_true", help="build the entity index used by query.py --index")
+	parser.add_argument("--textstore", action="store_true", help="pack the chunk texts into one file for looking up answer sources")
+	parser.add_argument("--llmcache", nargs="?", const=llm_cache.default_path, help="cache LM responses (in this file)")
+	parser.add_argument("--ledger", help=f"append LM call timings and tokens to this file (default: {ledger.file_name} in the output directory)")
+	parser.add_argument("--checkpoints", choices=["json", "sqlite"], help="checkpoint backend (default: sqlite if the output has one, else json)")
 	args = parser.parse_args()
 
+	if args.llmcache:
+		llm_cache.enable(args.llmcache)
+
 	kg = KGGen(
 		model=processing_model,
 	)
 
 	os.makedirs(args.output, exist_ok=True)
+	store = storage.open_chunk_store(args.output, args.checkpoints)
+	ledger.enable(args.ledger or f"{args.output}/{ledger.file_name}", "process")
 
 	dspy.enable_logging()
 	dspy.enable_litellm_logging()
 
-	chunks = pdf_chunks(args.filename)
+	chunks = pdf_chunks(args.filename, args.chunksize, args.chunkoverlap, args.pagecache, args.pageworkers)
 
 	if args.only:
-		chunks = [chunks[int(args.only)]]
-		process_chunks(chunks, args.output, kg, args.limit, args.partial, args.skiperrors, True)
+		chunks = [next(itertools.islice(chunks, int(args.only), None))]
+		process_chunks(chunks, store, kg, args.limit, args.partial, args.skiperrors, True)
 		dspy.inspect_history(n=1)
 	else:
-		process_chunks(chunks, args.output, kg, args.limit, args.partial, args.skiperrors)
+		process_chunks(chunks, store, kg, args.limit, args.partial, args.skiperrors, workers=args.workers)
 
 	if args.aggregate:
 		print("Aggregating chunks")
-		aggregate_chunks(kg, args.output)
+		aggregate_chunks(kg, args.output, store, args.update, args.aggregatefanin, args.aggregateworkers)
 	
 	if args.upload:
-		print("Collecting upload")
-		chunks = [storage.load_chunk(f"{args.output}/{f}") for f in os.listdir(args.output) if f.startswith("chunk-")]
-		relationships = make_relationship_references(chunks)
-		entities = make_entity_references(chunks)
-		# aggregated_graph = storage.load_graph(f"{args.output}/aggregated.json")
-
-		print("Uploading graph")
-		if not args.postgres:
-			print("(to neo4j)")
+		# Checkpoints are read in the background while we build or write
+		chunks = prefetch_chunks(store)
+
+		if args.stream and not (args.postgres or args.incremental):
+			print("Streaming upload (to neo4j)")
 			with GraphDatabase.driver(db_url, auth=(db_user, db_pass)) as driver:
 				driver.verify_connectivity()
 				driver.execute_query(
 					"MATCH (n) DETACH DELETE n",
 					database_=db_base,
 				)
-				write_graph_to_database(entities, relationships, driver)
+				stream_graph_to_database(chunks, driver, args.batchsize)
 		else:
-			print("(to postgres)")
-			ag = age.connect(
-				dbname=db_base,
-				user=db_user,
-				password=db_pass,
-				host="".join(db_url.split(":")[:-1]),
-				port=db_url.split(":")[-1],
-				graph="my_graph",
-			)
-			# We could just delete the graph here
-			ag.execCypher("MATCH (n) DETACH DELETE n")
-			write_graph_to_database_psql(entities, relationships, ag)
-			ag.commit()
-
+			print("Collecting upload")
+			graph = CompactGraph.from_chunks(chunks)
+			relationships = graph.relationship_references()
+			entities = graph.entity_references()
+			# aggregated_graph = storage.load_graph(f"{args.output}/aggregated.json")
+
+			print("Uploading graph")
+			if not args.postgres:
+				print("(to neo4j)")
+				with GraphDatabase.driver(db_url, auth=(db_user, db_pass)) as driver:
+					driver.verify_connectivity()
+					if args.incremental:
+						update_graph_in_database(entities, relationships, driver, args.bulk, args.batchsize)
+					else:
+						driver.execute_query(
+							"MATCH (n) DETACH DELETE n",
+							database_=db_base,
+						)
+						if args.bulk:
+							write_graph_to_database_bulk(entities, relationships, driver, args.batchsize)
+						else:
+							write_graph_to_database(entities, relationships, driver)
+			else:
+				print("(to postgres)")
+				ag = age.connect(
+					dbname=db_base,
+					user=db_user,
+					password=db_pass,
+					host="".join(db_url.split(":")[:-1]),
+					port=db_url.split(":")[-1],
+					graph="my_graph",
+				)
+				if args.incremental:
+					update_graph_in_database_psql(entities, relationships, ag, args.bulk, args.batchsize)
+				else:
+					# We could just delete the graph here
+					ag.execCypher("MATCH (n) DETACH DELETE n")
+					if args.bulk:
+						write_graph_to_database_psql_bulk(entities, relationships, ag, args.batchsize)
+					else:
+						write_graph_to_database_psql(entities, relationships, ag)
+				ag.commit()
+
+	if args.csr:
+		csr_graph.build(args.output, store)
+
+	if args.entityindex:
+		entity_index.build(args.output, store)
+
+	if args.textstore:
+		text_store.build(args.output, store)
+
+	if args.upload or args.csr:
+		# Cached neighbourhoods (and the like) of the old graph are stale now
+		storage.bump_graph_version()
+
+	store.close()
+	llm_cache.print_stats()
 	print("Done!")
 
 
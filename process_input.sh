@@ -17,7 +17,7 @@ function sig_handler_USR1() {
 
 	if [ ! -f "$OUTDIR/aggregated.json" ]; then
 		echo "Work is not done"
-		if [ $(ls $OUTDIR | wc -l) == $NOUTPUTS ]; then
+		if [ $(ls $OUTDIR | grep -v llm_ledger.jsonl | wc -l) == $NOUTPUTS ]; then
 			echo "No progress was made, skipping resubmission"
 		else
 			echo "Resubmitting job"
@@ -35,7 +35,8 @@ function sig_handler_USR1() {
 trap 'sig_handler_USR1' SIGUSR1
 
 mkdir -p $OUTDIR
-NOUTPUTS=$(ls $OUTDIR | wc -l)
+# The LM call ledger grows without any chunk finishing, it isn't progress
+NOUTPUTS=$(ls $OUTDIR | grep -v llm_ledger.jsonl | wc -l)
 
 echo "Moving apptainer to node local storage"
 cp ollama-phi4.sif $SLURM_TMPDIR
@@ -1,43 +1,133 @@
-import storage
-import regex as re 
+import argparse
+import ledger
 import os
-import argparse 
-import matplotlib.pyplot as plt
+
+
+# The p-th percentile of sorted values (nearest rank)
+def percentile(values, p):
+	if len(values) == 0:
+		return float("nan")
+	return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def tokens(entries, kind):
+	return sum(e.get(kind) or 0 for e in entries)
+
+
+# Completion tokens per second of LM time, for the calls that reported them
+def tokens_per_second(entries):
+	counted = [e for e in entries if e.get("completion_tokens") is not None]
+	latency = sum(e["latency"] for e in counted)
+	return tokens(counted, "completion_tokens") / latency if latency > 0 else float("nan")
+
+
+def summary(name, entries):
+	latencies = sorted(e["latency"] for e in entries)
+	errors = sum(1 for e in entries if "error" in e)
+	retries = sum(1 for e in entries if (e.get("attempt") or 1) > 1)
+	wall = max(e["start"] + e["latency"] for e in entries) - min(e["start"] for e in entries)
+	print(name)
+	print(f"\t{len(entries)} calls, {errors} errors, {retries} retries")
+	print(f"\t{tokens(entries, "prompt_tokens")} prompt tokens, {tokens(entries, "completion_tokens")} completion tokens")
+	print(
+		f"\tLatency p50 {percentile(latencies, 50):.2f}s, p90 {percentile(latencies, 90):.2f}s, "
+		f"p99 {percentile(latencies, 99):.2f}s, max {latencies[-1]:.2f}s"
+	)
+	print(f"\t{tokens_per_second(entries):.1f} completion tokens/s per call")
+	if wall > 0:
+		print(f"\t{len(entries) / wall * 60:.1f} calls/min, {tokens(entries, "completion_tokens") / wall:.1f} completion tokens/s overall")
+
+
+# Calls, tokens and latency in each bucket seconds since the first call
+def throughput(entries, bucket):
+	first = min(e["start"] for e in entries)
+	buckets = {}
+	for e in entries:
+		buckets.setdefault(int((e["start"] - first) // bucket), []).append(e)
+
+	rows = []
+	# Empty buckets are left out, a ledger can span runs days apart
+	for i in sorted(buckets.keys()):
+		in_bucket = buckets[i]
+		latencies = sorted(e["latency"] for e in in_bucket)
+		rows.append((
+			i * bucket,
+			len(in_bucket),
+			tokens(in_bucket, "prompt_tokens") + tokens(in_bucket, "completion_tokens"),
+			tokens(in_bucket, "completion_tokens") / bucket,
+			percentile(latencies, 50),
+		))
+	return rows
 
 
 def main():
 	parser = argparse.ArgumentParser()
-	parser.add_argument("files")
+	parser.add_argument("files", help=f"a ledger, or an output directory with a {ledger.file_name}")
+	parser.add_argument("--run", help="only calls from this run (process, streaming, query, labels)")
+	parser.add_argument("--bucket", default=60, type=float, help="seconds per throughput row")
+	parser.add_argument("--plot", action="store_true", help="plot latency and throughput (needs matplotlib)")
 	args = parser.parse_args()
 
-	chunks = []
-	times = []
-	for f in os.listdir(args.files):
-		m = re.match(r"chunk-(\d+)-\d+-\d+.json", f)
-		if m:
-			j = storage.load_json(f"{args.files}/{f}")
-			if "time" in j.keys():
-				chunk = m.group(1)
-				chunks.append(int(chunk))
-				time = j["time"]
-				times.append(time)
-	
-	mean = sum(times) / len(times)
-	median = sorted(times)[len(times)//2]
-	print(f"Mean time {mean:.2f}s")
-	print(f"Median time {median:.2f}s")
-
-	plt.subplot(2, 1, 1)
-	plt.title("Time to process chunk")
-	plt.xlabel("chunk")
-	plt.ylabel("time (s)")
-	plt.scatter(chunks, times)
-	
-	plt.subplot(2, 1, 2)
-	plt.title("Time distrobution")
-	plt.hist(times)
-
-	plt.show()
+	path = f"{args.files}/{ledger.file_name}" if os.path.isdir(args.files) else args.files
+	if not os.path.exists(path):
+		# Output directories from before the ledger don't have one
+		print(f"No LM call ledger at '{path}'")
+		return
+	entries = ledger.read(path)
+	if args.run:
+		entries = [e for e in entries if e.get("run") == args.run]
+	if len(entries) == 0:
+		print(f"No LM calls in '{path}'")
+		return
+	entries.sort(key=lambda e: e["start"])
+
+	summary("All calls", entries)
+	groups = {}
+	for e in entries:
+		groups.setdefault((e.get("run"), e.get("model")), []).append(e)
+	if len(groups) > 1:
+		for (run, model), group in sorted(groups.items(), key=lambda g: str(g[0])):
+			summary(f"{run} / {model}", group)
+
+	# LM time per chunk, summed over its calls (chunks run concurrently with
+	# --workers, so this isn't wall time)
+	chunks = {}
+	for e in entries:
+		if e.get("checkpoint") is not None:
+			chunks[e["checkpoint"]] = chunks.get(e["checkpoint"], 0) + e["latency"]
+	if len(chunks) > 0:
+		times = sorted(chunks.values())
+		print(f"Chunks ({len(times)})")
+		print(f"\tMean time {sum(times) / len(times):.2f}s")
+		print(f"\tMedian time {percentile(times, 50):.2f}s, p90 {percentile(times, 90):.2f}s")
+
+	rows = throughput(entries, args.bucket)
+	print("Throughput")
+	print(f"\t{"time (s)":>10} {"calls":>6} {"tokens":>8} {"tok/s":>8} {"p50 (s)":>8}")
+	for st, calls, n_tokens, rate, p50 in rows:
+		print(f"\t{st:>10.0f} {calls:>6} {n_tokens:>8} {rate:>8.1f} {p50:>8.2f}")
+
+	if args.plot:
+		import matplotlib.pyplot as plt
+
+		first = entries[0]["start"]
+		plt.subplot(3, 1, 1)
+		plt.title("LM call latency")
+		plt.xlabel("time (s)")
+		plt.ylabel("latency (s)")
+		plt.scatter([e["start"] - first for e in entries], [e["latency"] for e in entries], s=4)
+
+		plt.subplot(3, 1, 2)
+		plt.title("Latency distribution")
+		plt.hist([e["latency"] for e in entries], bins=50)
+
+		plt.subplot(3, 1, 3)
+		plt.title("Completion tokens/s")
+		plt.xlabel("time (s)")
+		plt.plot([r[0] for r in rows], [r[3] for r in rows])
+
+		plt.tight_layout()
+		plt.show()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,22 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncDriver
 from kg_gen import KGGen, Graph
 import json 
 import os
+import time
+import math
+from collections import Counter
+import asyncio
+from contextlib import contextmanager
 import argparse
 import storage
+import llm_cache
+import ledger
+import csr_graph
+import entity_index
+import entity_matcher
+import text_store
+import metrics
+from graph_cache import query_cache
 import regex as re
 import dspy
 import age
@@ -15,8 +28,14 @@ db_base = os.getenv("DB_DATABASE", "neo4j")
 
 query_model = os.getenv("QUERY_MODEL", "openai/gpt-4o-mini")
 
+# At most this many triples are sent to the rerank prompt
+prerank_limit = int(os.getenv("PRERANK_LIMIT", "60"))
+# How much the source chunks' text counts for when preranking (0 to not read them)
+prerank_text_weight = float(os.getenv("PRERANK_TEXT_WEIGHT", "0"))
+
 
 def k_hops_neighbours_postgres(e, ag, k=2):
+	metrics.graph_round_trips.inc(backend="postgres")
 	cursor = ag.execCypher("""
 		MATCH p=(a:Entity {id: %s})-[r*..%s]->(b:Entity) 
 		RETURN b.id as idk, nodes(p) as idk2, r as idk3
@@ -38,6 +57,7 @@ def k_hops_neighbours_postgres(e, ag, k=2):
 
 
 def k_hops_neighbours_neo4j(e1, driver, k=2):
+	metrics.graph_round_trips.inc(backend="neo4j")
 	neighbours, _, _ = driver.execute_query("""
 		MATCH p = ALL SHORTEST (e1:Entity {id: $e1})-[r*..K_VALUE]-(neighbours:Entity)
 		RETURN neighbours.id AS id, [n in nodes(p) | n.id] AS nodes, [e in r | TYPE(e)] AS edges, [e in r | e.tags] AS tags
@@ -61,18 +81,153 @@ def k_hops_neighbours_neo4j(e1, driver, k=2):
 
 # Returns [(node, nodes to get there, edges to get there, sources for those edges)]
 def k_hops_neighbours(e, graph, k=2):
-	if isinstance(graph, age.age.Age):
+	if isinstance(graph, csr_graph.CSRGraph):
+		return graph.k_hops_neighbours(e, k)
+	elif isinstance(graph, age.age.Age):
 		return k_hops_neighbours_postgres(e, graph, k)
 	else:
 		return k_hops_neighbours_neo4j(e, graph, k)
 
 
+def k_hops_neighbours_batch_postgres(es, ag, k=2):
+	result = {e: [] for e in es}
+	if len(es) == 0:
+		return result
+
+	# Each entity is its own parameter so that psycopg quotes it
+	metrics.graph_round_trips.inc(backend="postgres")
+	cursor = ag.execCypher(f"""
+		MATCH p=(a:Entity)-[r*..%s]->(b:Entity) 
+		WHERE a.id IN [{", ".join(["%s"] * len(es))}]
+		RETURN a.id as idk0, b.id as idk, nodes(p) as idk2, r as idk3
+	""", params=(k, *es), cols=["source", "name", "nodes", "edges"])
+
+	for source, name, nodes, edges in cursor:
+		result[source].append((
+			storage.from_neo4j_repr(name),
+			[storage.from_neo4j_repr(node.properties["id"]) for node in nodes],
+			[storage.from_neo4j_repr(edge.label) for edge in edges],
+			[json.loads(edge.properties["tags"].replace("\\", "")) for edge in edges],
+		))
+
+	# Sort by closest first 
+	for neighbours in result.values():
+		neighbours.sort(key=lambda v: len(v[2]))
+
+	return result
+
+
+k_hops_neighbours_batch_cypher = """
+	UNWIND $es AS e1
+	MATCH p = ALL SHORTEST (:Entity {id: e1})-[r*..K_VALUE]-(neighbours:Entity)
+	RETURN e1 AS source, neighbours.id AS id, [n in nodes(p) | n.id] AS nodes, [e in r | TYPE(e)] AS edges, [e in r | e.tags] AS tags
+	ORDER BY length(p)
+"""
+
+
+def k_hops_neighbours_batch_neo4j(es, driver, k=2):
+	if len(es) == 0:
+		return {}
+
+	metrics.graph_round_trips.inc(backend="neo4j")
+	neighbours, _, _ = driver.execute_query(
+		k_hops_neighbours_batch_cypher.replace("K_VALUE", str(k)),
+		es=es,
+		database_=db_base,
+	)
+	return _neo4j_neighbours(es, neighbours)
+
+
+# The same with an AsyncDriver
+async def k_hops_neighbours_batch_neo4j_async(es, driver, k=2):
+	if len(es) == 0:
+		return {}
+
+	metrics.graph_round_trips.inc(backend="neo4j")
+	neighbours, _, _ = await driver.execute_query(
+		k_hops_neighbours_batch_cypher.replace("K_VALUE", str(k)),
+		es=es,
+		database_=db_base,
+	)
+	return _neo4j_neighbours(es, neighbours)
+
+
+def _neo4j_neighbours(es, neighbours):
+	result = {e: [] for e in es}
+	for source, node, nodes, edges, tags in neighbours:
+		result[source].append((
+			storage.from_neo4j_repr(node),
+			[storage.from_neo4j_repr(n) for n in nodes],
+			[storage.from_neo4j_repr(e) for e in edges],
+			[json.loads(tag) for tag in tags],
+		))
+
+	return result
+
+
+# k_hops_neighbours for many entities in one round trip
+# Neighbourhoods in the cache (a NeighbourhoodCache) aren't fetched again
+# Returns {entity: [(node, nodes to get there, edges to get there, sources for those edges)]}
+def k_hops_neighbours_batch(es, graph, k=2, cache=None):
+	result, es = _cached_neighbours(es, k, cache)
+
+	if isinstance(graph, csr_graph.CSRGraph):
+		fetched = graph.k_hops_neighbours_batch(es, k)
+	elif isinstance(graph, age.age.Age):
+		fetched = k_hops_neighbours_batch_postgres(es, graph, k)
+	else:
+		fetched = k_hops_neighbours_batch_neo4j(es, graph, k)
+
+	return _cache_neighbours(result, fetched, k, cache)
+
+
+# The same, but graph can be an AsyncDriver
+# The other backends are blocking, so they run in a thread
+async def k_hops_neighbours_batch_async(es, graph, k=2, cache=None):
+	result, es = _cached_neighbours(es, k, cache)
+
+	if isinstance(graph, AsyncDriver):
+		fetched = await k_hops_neighbours_batch_neo4j_async(es, graph, k)
+	else:
+		fetched = await asyncio.to_thread(k_hops_neighbours_batch, es, graph, k)
+
+	return _cache_neighbours(result, fetched, k, cache)
+
+
+# Returns the cached neighbourhoods and the entities that still need fetching
+def _cached_neighbours(es, k, cache):
+	es = list(dict.fromkeys(es))
+	result = {}
+	if cache is not None:
+		for e in es:
+			if (neighbours := cache.get(e, k)) is not None:
+				result[e] = neighbours
+		es = [e for e in es if e not in result]
+	return result, es
+
+
+def _cache_neighbours(result, fetched, k, cache):
+	if cache is not None:
+		for e, neighbours in fetched.items():
+			cache.put(e, k, neighbours)
+	result.update(fetched)
+	return result
+
+
 # Returns a collection of (relationship segment, sources)
-def path_based_subgraph(eg, driver):
+def path_based_subgraph(eg, driver, cache=None):
+	# Every e1 comes from eg, so fetch them all at once
+	return path_subgraph(eg, k_hops_neighbours_batch(eg, driver, 2, cache))
+
+
+# path_based_subgraph from the 2-hop neighbourhoods of eg
+def path_subgraph(eg, neighbourhoods):
 	gpathq = []
 	sources = []
 	segment = []
 	segment_sources = []
+	if len(eg) == 0:
+		return [], []
 	e1 = eg[0]
 	candidates = eg[1:]
 	while len(candidates) != 0:
@@ -80,7 +235,7 @@ def path_based_subgraph(eg, driver):
 		print(f"candidates: {candidates}")
 
 		found_neighbour = False
-		neighbours = k_hops_neighbours(e1, driver, 2)
+		neighbours = neighbourhoods[e1]
 		for e2, nodes, edges, path_srcs in neighbours:
 			if e2 != e1 and e2 in candidates:
 				print(f"path to '{e2}'")
@@ -117,13 +272,18 @@ def path_based_subgraph(eg, driver):
 	return gpathq, sources
 
 
-def neighbour_based_subgraph(query, eg, driver):
+def neighbour_based_subgraph(query, eg, driver, cache=None):
+	return neighbour_subgraph(eg, k_hops_neighbours_batch(eg, driver, k=1, cache=cache))
+
+
+# neighbour_based_subgraph from the 1-hop neighbourhoods of eg
+def neighbour_subgraph(eg, neighbourhoods):
 	gneiq = []
 	sources = []
 	for e in eg:
 		# print(f"neighbours of {e}")
 
-		e_neighbours = k_hops_neighbours(e, driver, k=1)
+		e_neighbours = neighbourhoods[e]
 		# print(e_neighbours)
 
 		for ep, _, rel, s in e_neighbours:
@@ -143,7 +303,119 @@ def neighbour_based_subgraph(query, eg, driver):
 	return gneiq, sources
 
 
-def path_evidence(q, gpathq, sources, k):
+# {triple: sources}, repeated triples get the sources of every copy
+def triple_sources(triples, sources):
+	merged = {}
+	for triple, srcs in zip(triples, sources):
+		merged_srcs = merged.setdefault(tuple(triple), [])
+		for src in srcs:
+			if src not in merged_srcs:
+				merged_srcs.append(src)
+	return merged
+
+
+# Okapi BM25 score of each document (a list of tokens) for the query tokens
+def bm25_scores(query_tokens, documents, k1=1.5, b=0.75):
+	if len(documents) == 0:
+		return []
+	average_length = max(sum(len(d) for d in documents) / len(documents), 1)
+	df = Counter(t for d in documents for t in set(d))
+	query_tokens = set(query_tokens)
+
+	scores = []
+	for d in documents:
+		tf = Counter(d)
+		score = 0
+		for t in query_tokens:
+			if t in tf:
+				idf = math.log(1 + (len(documents) - df[t] + 0.5) / (df[t] + 0.5))
+				score += idf * tf[t] * (k1 + 1) / (tf[t] + k1 * (1 - b + b * len(d) / average_length))
+		scores.append(score)
+	return scores
+
+
+# Keeps the limit triples of {triple: sources} that best match the question
+# lexically, in their original order, so hub entities don't flood the rerank
+# prompt. chunk_text (checkpoint -> text) adds the source chunks' text as a
+# weaker signal
+def prerank_triples(question, candidates, limit=prerank_limit, chunk_text=None):
+	if len(candidates) <= limit:
+		return candidates
+	query_tokens = [t for t in entity_matcher.tokens(question) if t not in entity_matcher.stop_words]
+	triples = list(candidates.keys())
+	scores = bm25_scores(query_tokens, [entity_matcher.tokens(" ".join(t)) for t in triples])
+
+	if chunk_text is not None and prerank_text_weight > 0:
+		chunk_tokens = {}
+		documents = []
+		for triple in triples:
+			document = []
+			for src in candidates[triple]:
+				if (checkpoint := src["checkpoint"]) not in chunk_tokens:
+					chunk_tokens[checkpoint] = entity_matcher.tokens(chunk_text(checkpoint))
+				document.extend(chunk_tokens[checkpoint])
+			documents.append(document)
+		for i, score in enumerate(bm25_scores(query_tokens, documents)):
+			scores[i] += prerank_text_weight * score
+
+	best = sorted(range(len(triples)), key=lambda i: -scores[i])[:limit]
+	print(f"Preranked {len(triples)} triples down to {limit}")
+	return {triples[i]: candidates[triples[i]] for i in sorted(best)}
+
+
+# Chunk text and tags by checkpoint (get/text), from the text store if it has
+# been built, and from the checkpoints for chunks added since (or all of them
+# if it hasn't)
+class ChunkSources:
+	def __init__(self, graphs_directory):
+		self.graphs_directory = graphs_directory
+		self.texts = text_store.shared(graphs_directory)
+		self.store = None
+
+	# The chunk store is only opened if the text store is missing a chunk
+	def _store(self):
+		if self.store is None:
+			self.store = storage.open_chunk_store(self.graphs_directory)
+		return self.store
+
+	def _in_texts(self, checkpoint):
+		return self.texts is not None and checkpoint in self.texts
+
+	def text(self, checkpoint):
+		if self._in_texts(checkpoint):
+			return self.texts.text(checkpoint)
+		return self._store().text(checkpoint)
+
+	def get(self, checkpoint):
+		if self._in_texts(checkpoint):
+			return self.texts.get(checkpoint)
+		return text_store.text_and_tags(self._store().get(checkpoint))
+
+	def close(self):
+		if self.store is not None:
+			self.store.close()
+
+
+@contextmanager
+def chunk_sources(graphs_directory):
+	sources = ChunkSources(graphs_directory)
+	try:
+		yield sources
+	finally:
+		sources.close()
+
+
+# chunk_text for prerank_triples, if the chunk text is used
+@contextmanager
+def prerank_chunk_text(graphs_directory):
+	if graphs_directory is None or prerank_text_weight <= 0:
+		yield None
+		return
+	with chunk_sources(graphs_directory) as store:
+		yield store.text
+
+
+def pself_predictor():
 	class PSelfSignature(dspy.Signature):
 		"""
 		There is a question and some knowledge graph triples. Rerank the knowledge graph triples and output at most k important and relevant triples for solving the given question.
@@ -153,20 +425,10 @@ def path_evidence(q, gpathq, sources, k):
 		knowledge_graph: list[tuple[str, str, str]] = dspy.InputField()
 		reranked_knowledge_graph: list[tuple[str, str, str]] = dspy.OutputField(desc="reranked knowledge graph")
 	
-	pself = dspy.Predict(PSelfSignature)
-	gselfq = pself(question=q, knowledge_graph=gpathq, k=k).reranked_knowledge_graph
+	return dspy.Predict(PSelfSignature)
 
-	if len(gselfq) == 0:
-		print("WARN: no relevant sources")
-
-	# Try to match output sources with the input sources
-	# Could return this, the raw relations, and the plain language relations
-	gselfq_sources = []
-	for triple in gselfq:
-		i = gpathq.index(triple)
-		source = sources[i]
-		gselfq_sources.append(source)
 
+def pinference_predictor():
 	class PInferenceSignature(dspy.Signature):
 		"""
 		There are some knowledge graph paths. Try to convert them to natural language, respectively.
@@ -174,18 +436,98 @@ def path_evidence(q, gpathq, sources, k):
 		knowledge_graph_paths: list[tuple[str, str, str]] = dspy.InputField()
 		natural_language_paths: list[tuple[str, str, str]] = dspy.OutputField()
 	
-	pinference = dspy.Predict(PInferenceSignature)
+	return dspy.Predict(PInferenceSignature)
+
+
+def panswer_predictor():
+	class PAnswerSignature(dspy.Signature):
+		"""
+		Answer the question using the knowledge graph information. 
+		"""
+		question: str = dspy.InputField()
+		path_based_evidence: list[tuple[str, str, str]] = dspy.InputField()
+		# neighbour_based_evidence: list[tuple[str, str, str]] = dspy.InputField()
+		answer: str = dspy.OutputField()
+	
+	return dspy.Predict(PAnswerSignature)
+
+
+# Try to match output sources with the input sources ({triple: sources})
+# Triples the LM made up rather than picked are dropped
+def reranked_sources(gselfq, candidates):
+	if len(gselfq) == 0:
+		print("WARN: no relevant sources")
+
+	triples = []
+	gselfq_sources = []
+	for triple in gselfq:
+		if (source := candidates.get(tuple(triple))) is None:
+			print(f"WARN: reranked triple {triple} wasn't a candidate")
+			continue
+		triples.append(triple)
+		gselfq_sources.append(source)
+	return triples, gselfq_sources
+
+
+def path_evidence(q, gpathq, sources, k, chunk_text=None):
+	candidates = prerank_triples(q, triple_sources(gpathq, sources), prerank_limit, chunk_text)
+
+	pself = pself_predictor()
+	gselfq = pself(question=q, knowledge_graph=list(candidates.keys()), k=k).reranked_knowledge_graph
+
+	# Could return this, the raw relations, and the plain language relations
+	gselfq, gselfq_sources = reranked_sources(gselfq, candidates)
+
+	pinference = pinference_predictor()
 	a = pinference(knowledge_graph_paths=gselfq).natural_language_paths
 
 	return a, gselfq_sources
 
 
-def query(question, kg, driver, k):
+# Splits the paths of path_based_subgraph into triples
+def path_triples(gpathq, gpathq_sources):
+	gpathq_triples = []
+	gpathq_triples_sources = []
+	for path, srcs in zip(gpathq, gpathq_sources):
+		# print("path", path, srcs)
+		for i, src in zip(range(0, len(path)//2), srcs):
+			a = path[2*i+0]
+			r = path[2*i+1]
+			b = path[2*i+2]
+			gpathq_triples.append((a, r, b))
+			# print(a, r, b, src)
+			gpathq_triples_sources.append(src)
+	return gpathq_triples, gpathq_triples_sources
+
+
+# The graph entities in the question, or None if the matcher finds none
+# (or there isn't one) and the LM has to pull them out
+def match_entities(question, matcher):
+	if matcher is None:
+		return None
+	matched = matcher.match(question)
+	if len(matched) == 0:
+		print("No known entities in the question")
+		return None
+	return matched
+
+
+# cache is a NeighbourhoodCache to share between queries
+# index is an EntityIndex to link the question's entities to the graph's
+# matcher is an EntityMatcher to find them without the LM
+# graphs_directory is where the chunk text comes from, if it's used for preranking
+def query(question, kg, driver, k, cache=None, index=None, matcher=None, graphs_directory=None):
 	print(f"query: '{question}'")
-	qg = kg.generate(
-		input_data=question,
-	)
-	e = list(qg.entities)
+	if cache is None:
+		# The 1-hop neighbourhoods are still found in the 2-hop ones
+		cache = query_cache()
+	if (matched := match_entities(question, matcher)) is not None:
+		e = matched
+	else:
+		qg = kg.generate(
+			input_data=question,
+		)
+		e = list(qg.entities)
 	print(f"entities: {e}")
 
 	# Compute he
@@ -194,50 +536,34 @@ def query(question, kg, driver, k):
 	# Find of like this but you extract the one with the highest similarity
 	# eg = st_model.similairties(he, hg)
 	# We don't actually need to do that I think
-	eg = e 
+	# An entity that isn't in the graph has no neighbours, so match them up
+	# with the entity index (if there is one) instead, matched ones already are
+	eg = index.link(e) if index is not None and matched is None else e
 
 	# The sources and paths for this are multidimensional, so we need to split them into triples 
-	gpathq, gpathq_sources = path_based_subgraph(eg, driver)
+	gpathq, gpathq_sources = path_based_subgraph(eg, driver, cache)
 	print("Path-based sub-graph:")
 	for path in gpathq:
 		print(" -> ".join(path))
 	print("Sources", gpathq_sources)
 
 	# Extract triples from the paths
-	gpathq_triples = []
-	gpathq_triples_sources = []
-	for path, srcs in zip(gpathq, gpathq_sources):
-		# print("path", path, srcs)
-		for i, src in zip(range(0, len(path)//2), srcs):
-			a = path[2*i+0]
-			r = path[2*i+1]
-			b = path[2*i+2]
-			gpathq_triples.append((a, r, b))
-			# print(a, r, b, src)
-			gpathq_triples_sources.append(src)
+	gpathq_triples, gpathq_triples_sources = path_triples(gpathq, gpathq_sources)
 
-	gneiq, gneiq_sources = neighbour_based_subgraph(question, eg, driver)
+	gneiq, gneiq_sources = neighbour_based_subgraph(question, eg, driver, cache)
 	print("Neighbour-based sub-graph:")
 	for path, srcs in zip(gneiq, gneiq_sources):
 		print(" -> ".join(path))
 		print(srcs)
 	
 	# Both again, see what happens
-	path_statements, path_sources = path_evidence(question, gpathq_triples + gneiq, gpathq_triples_sources + gneiq_sources, k)
+	with prerank_chunk_text(graphs_directory) as chunk_text:
+		path_statements, path_sources = path_evidence(question, gpathq_triples + gneiq, gpathq_triples_sources + gneiq_sources, k, chunk_text)
 	# Not described in the paper?
 	# MindMap_revised.py uses different prompts than the paper too 
 	neighbourstuff = None 
 
-	class PAnswerSignature(dspy.Signature):
-		"""
-		Answer the question using the knowledge graph information. 
-		"""
-		question: str = dspy.InputField()
-		path_based_evidence: list[tuple[str, str, str]] = dspy.InputField()
-		# neighbour_based_evidence: list[tuple[str, str, str]] = dspy.InputField()
-		answer: str = dspy.OutputField()
-	
-	panswer = dspy.Predict(PAnswerSignature)
+	panswer = panswer_predictor()
 	answer = panswer(question=question, path_based_evidence=path_statements).answer
 
 	return {
@@ -272,32 +598,125 @@ def show_answer(answer_dict, graphs_directory):
 		else:
 			print(f"  - no source provided!")
 	print()
-	for i, chunk_file in chunk_files:
-		chunk = storage.load_json(f"{graphs_directory}/{chunk_file}")
-		print(f"Chunk {i+1} (pages [{chunk["tags"]["page_st"]}, {chunk["tags"]["page_en"]}]) text: ")
-		print(f"'{chunk["text"]}'")
+	with chunk_sources(graphs_directory) as store:
+		for i, chunk_file in chunk_files:
+			chunk = store.get(chunk_file)
+			print(f"Chunk {i+1} (pages [{chunk["tags"]["page_st"]}, {chunk["tags"]["page_en"]}]) text: ")
+			print(f"'{chunk["text"]}'")
 
 
 # Uses the query model LLM to respond 
 # Also appends chunk texts to the response (for testing)
-def query_hack(question, kg, driver, k, graphs_directory="graphs/fema_tags"):
+def query_hack(question, kg, driver, k, graphs_directory="graphs/fema_tags", cache=None, index=None, matcher=None):
 	with dspy.context(lm=dspy.LM(query_model)):
-		result = query(question, kg, driver, k)
+		result = query(question, kg, driver, k, cache, index, matcher, graphs_directory)
+		result["texts"] = load_chunk_texts(result["sources"], graphs_directory)
+		return result
 
-		chunk_texts = {}
 
-		chunk_files = []
-		for i, (statement, sources) in enumerate(zip(result["statements"], result["sources"])):
-			if len(sources) > 0:
-				for source in sources:
-					chunk_files.append((source["chunk_i"], source["checkpoint"]))
-		for i, chunk_file in chunk_files:
-			chunk = storage.load_json(f"{graphs_directory}/{chunk_file}")
-			chunk_texts[i] = chunk["text"]
-		
+# chunk_i -> text, for the chunks of each statement's sources
+def load_chunk_texts(statement_sources, graphs_directory):
+	chunk_texts = {}
+
+	# Each chunk only once, however many statements it backs
+	chunk_files = {}
+	for sources in statement_sources:
+		for source in sources:
+			chunk_files[source["chunk_i"]] = source["checkpoint"]
+	with chunk_sources(graphs_directory) as store:
+		for i, chunk_file in chunk_files.items():
+			chunk_texts[i] = store.text(chunk_file)
+
+	return chunk_texts
+
+
+# Adds the time spent in the block to timings[name]
+@contextmanager
+def timed(timings, name):
+	start = time.perf_counter()
+	try:
+		with ledger.tagged(stage=name):
+			yield
+	finally:
+		timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+# query, but independent stages run concurrently and the event loop is never
+# blocked, for the server
+# driver can be an AsyncDriver, lm is the model used for the dspy calls
+# If graphs_directory is given the sources' chunk texts are loaded as "texts"
+# while the answer is being written
+# The result has the time spent in each stage as "timings"
+async def query_async(question, kg, driver, k, cache=None, lm=None, graphs_directory=None, index=None, matcher=None):
+	print(f"query: '{question}'")
+	if cache is None:
+		cache = query_cache()
+	timings = {}
+	start = time.perf_counter()
+
+	with timed(timings, "entities"):
+		if (matched := match_entities(question, matcher)) is not None:
+			e = matched
+		else:
+			qg = await asyncio.to_thread(kg.generate, input_data=question)
+			e = list(qg.entities)
+	print(f"entities: {e}")
+	eg = index.link(e) if index is not None and matched is None else e
+
+	# The 1-hop neighbourhoods come out of the 2-hop fetch through the cache,
+	# so the neighbour subgraph doesn't wait on a round trip of its own
+	with timed(timings, "path_subgraph"):
+		paths = await k_hops_neighbours_batch_async(eg, driver, 2, cache)
+		gpathq, gpathq_sources = path_subgraph(eg, paths)
+	with timed(timings, "neighbour_subgraph"):
+		neighbours = await k_hops_neighbours_batch_async(eg, driver, 1, cache)
+		gneiq, gneiq_sources = neighbour_subgraph(eg, neighbours)
+	gpathq_triples, gpathq_triples_sources = path_triples(gpathq, gpathq_sources)
+	candidates = triple_sources(gpathq_triples + gneiq, gpathq_triples_sources + gneiq_sources)
+
+	with timed(timings, "prerank"):
+		with prerank_chunk_text(graphs_directory) as chunk_text:
+			candidates = await asyncio.to_thread(prerank_triples, question, candidates, prerank_limit, chunk_text)
+
+	with timed(timings, "rerank"):
+		pself = dspy.asyncify(pself_predictor())
+		gselfq = (await pself(question=question, knowledge_graph=list(candidates.keys()), k=k, lm=lm)).reranked_knowledge_graph
+	gselfq, path_sources = reranked_sources(gselfq, candidates)
+
+	async def answer():
+		with timed(timings, "inference"):
+			pinference = dspy.asyncify(pinference_predictor())
+			statements = (await pinference(knowledge_graph_paths=gselfq, lm=lm)).natural_language_paths
+		with timed(timings, "answer"):
+			panswer = dspy.asyncify(panswer_predictor())
+			answer = (await panswer(question=question, path_based_evidence=statements, lm=lm)).answer
+		return statements, answer
+
+	async def texts():
+		if graphs_directory is None:
+			return None
+		with timed(timings, "sources"):
+			return await asyncio.to_thread(load_chunk_texts, path_sources, graphs_directory)
+
+	# The sources are known once reranked, so their texts load alongside the answer
+	(path_statements, answer), chunk_texts = await asyncio.gather(answer(), texts())
+	timings["total"] = time.perf_counter() - start
+
+	result = {
+		"question": question,
+		"answer": answer,
+		"statements": path_statements,
+		"sources": path_sources,
+		"timings": timings,
+	}
+	if chunk_texts is not None:
 		result["texts"] = chunk_texts
+	return result
 
-		return result
+
+# query_hack for async callers
+async def query_hack_async(question, kg, driver, k, graphs_directory="graphs/fema_tags", cache=None, index=None, matcher=None):
+	return await query_async(question, kg, driver, k, cache, dspy.LM(query_model), graphs_directory, index, matcher)
 
 
 def main():
@@ -306,8 +725,18 @@ def main():
 	parser.add_argument("query")
 	parser.add_argument('-k', nargs='?', const=5, type=int)
 	parser.add_argument("--postgres", action="store_true")
+	parser.add_argument("--local", action="store_true", help="query the csr graph built from the chunk checkpoints, no database needed")
+	parser.add_argument("--index", action="store_true", help="link the question's entities to the graph's with the entity index")
+	parser.add_argument("--match", action="store_true", help="look for the graph's entities in the question before asking the LM for them")
+	parser.add_argument("--llmcache", nargs="?", const=llm_cache.default_path, help="cache LM responses (in this file)")
+	parser.add_argument("--ledger", nargs="?", const=ledger.default_path, help="append LM call timings and tokens to this file")
 	args = parser.parse_args()
 
+	if args.llmcache:
+		llm_cache.enable(args.llmcache)
+	if args.ledger:
+		ledger.enable(args.ledger, "query")
+
 	lm = dspy.LM(query_model)
 	dspy.configure(lm=lm)
 
@@ -315,7 +744,16 @@ def main():
 		model=query_model,
 	)
 
-	if args.postgres:
+	index = entity_index.load(args.files) if args.index else None
+	matcher = entity_matcher.load(args.files) if args.match else None
+
+	if args.local:
+		driver = csr_graph.load(args.files)
+		a = query(args.query, kg, driver, args.k, index=index, matcher=matcher, graphs_directory=args.files)
+		print()
+		show_answer(a, args.files)
+		driver.close()
+	elif args.postgres:
 		driver = age.connect(
 			dbname=db_base,
 			user=db_user,
@@ -324,17 +762,19 @@ def main():
 			port=db_url.split(":")[-1],
 			graph="my_graph",
 		)
-		a = query(args.query, kg, driver, args.k)
+		a = query(args.query, kg, driver, args.k, index=index, matcher=matcher, graphs_directory=args.files)
 		print()
 		show_answer(a, args.files)
 	else:
 		with GraphDatabase.driver(db_url, auth=(db_user, db_pass)) as driver:
 			driver.verify_connectivity()
 
-			a = query(args.query, kg, driver, args.k)
+			a = query(args.query, kg, driver, args.k, index=index, matcher=matcher, graphs_directory=args.files)
 			print()
 			show_answer(a, args.files)
 
+	llm_cache.print_stats()
+
 
 if __name__ == "__main__":
 	main()
@@ -1,14 +1,28 @@
 from fastapi import FastAPI, HTTPException, UploadFile, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 import query
 from pydantic import BaseModel
 import os
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase
 from kg_gen import KGGen
 import labels
+import llm_cache
+import ledger
 import storage
+import csr_graph
+import entity_index
+import text_store
+import metrics
+from entity_matcher import EntityMatcher
+from graph_cache import NeighbourhoodCache, AnswerCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import networkx as nx
+import threading
+import asyncio
+import dspy
 import logging
+import time
 
 
 class QueryItem(BaseModel):
@@ -28,31 +42,284 @@ logging.basicConfig(
 db_url = os.getenv("DB_HOST", "neo4j://localhost:7687")
 db_user = os.getenv("DB_USER", "neo4j")
 db_pass = os.getenv("DB_PASSWORD", "no_password")
-driver = GraphDatabase.driver(db_url, auth=(db_user, db_pass))
+# Set GRAPH_BACKEND=csr to query the csr graph of the chunk checkpoints instead of neo4j
+graph_backend = os.getenv("GRAPH_BACKEND", "neo4j")
+# The csr graph is reopened whenever it's rebuilt, see graph_driver
+if graph_backend == "csr":
+	driver = csr_graph.shared("./graphs/fema_tags")
+	query_driver = driver
+else:
+	driver = GraphDatabase.driver(db_url, auth=(db_user, db_pass))
+	# Queries use the async driver so they don't hold up the event loop
+	query_driver = AsyncGraphDatabase.driver(db_url, auth=(db_user, db_pass))
 kg = KGGen(model=os.getenv("QUERY_MODEL", "openai/gpt-4o-mini"))
 
+
+# The graph queries should use, the current csr graph or the async driver
+# Blocks while a rebuilt csr graph is opened
+def graph_driver():
+	if graph_backend == "csr":
+		return csr_graph.shared("./graphs/fema_tags")
+	return query_driver
+
+# Set LLM_CACHE to a file to cache LM responses there 
+if os.getenv("LLM_CACHE"):
+	llm_cache.enable(os.getenv("LLM_CACHE"))
+
+# LM calls and tokens are counted as they're made
+dspy.configure(callbacks=[metrics.LMMetrics()])
+# Set LLM_LEDGER to a file to log every LM call there too (labelling included)
+if os.getenv("LLM_LEDGER"):
+	ledger.enable(os.getenv("LLM_LEDGER"), "query")
+
+chunk_store = storage.open_chunk_store("./graphs/fema_tags")
+
 labels_cache = "graphs/kg_labels.json"
-if not os.path.isfile(labels_cache):	
+# The graph version the labels were made from
+labels_version = "graphs/kg_labels.version"
+
+# Set by the startup thread, requests make do without them until then
+# Each is replaced whole, so a request that took one keeps a consistent copy
+data = None
+index = None
+matcher = None
+
+# What the startup thread is up to, for /ready
+startup = {
+	"state": "starting",
+	"stage": None,
+	"labelled": 0,
+	"to_label": 0,
+	"snapshot": False,
+	"error": None,
+	"started": time.time(),
+	"finished": None,
+	# Each part's state (pending, loading, building, ready, failed or
+	# disabled) and error, queries go ahead without an entity index that
+	# failed to load
+	"components": {
+		"entity_index": {"state": "pending", "error": None},
+		"entity_matcher": {"state": "pending", "error": None},
+		"labels": {"state": "pending", "error": None},
+	},
+}
+
+
+def _component(name, state, error=None):
+	startup["components"][name] = {"state": state, "error": error}
+
+
+def _labelled():
+	startup["labelled"] += 1
+
+
+# Communities and their labels of the current graph, as a fresh tree
+def build_labels():
+	startup["stage"] = "fetch graph"
 	print("Fetch graph...")
-	graph = labels.nx_graph_neo4j(driver, refresh=True)
+	if graph_backend == "csr":
+		graph = graph_driver().to_networkx()
+	else:
+		graph = labels.nx_graph_neo4j(driver, refresh=True)
 	
+	startup["stage"] = "find communities"
 	print("Find communities...")
-	data = labels.graph_communities(graph)
+	tree = labels.graph_communities(graph)
 	
+	startup["stage"] = "label communities"
 	print("Label communities...")
-	calls, tokens = labels.label_count(data)
+	calls, tokens = labels.label_count(tree)
 	token_cost = 1.100 / 1e6
 	print(f"Labelling will make {calls} calls with {tokens} input tokens ({tokens*token_cost}$)")
-	labels.add_labels(data)
+	startup["to_label"] = labels.label_calls(tree)
+	labels.add_labels(tree, _labelled)
 
+	startup["stage"] = "accumulate tags"
 	print("Accumulate tags...")
-	labels.accumulate_tags(data)
-	
-	print("Save output...")
-	storage.save_json(data, labels_cache)
-data = storage.load_json(labels_cache)
+	labels.accumulate_tags(tree)
+	return tree
 
-app = FastAPI()
+
+# Loads what doesn't need the graph rebuilt first, then rebuilds the labels
+# if the snapshot is missing or older than the uploaded graph
+# Set LABELS_REBUILD=1 to rebuild them regardless
+def start():
+	global data, index, matcher
+	startup["state"] = "loading"
+	startup["stage"] = "entity index"
+	# Queries link entities without the index if it can't be loaded
+	try:
+		_component("entity_index", "loading")
+		index = entity_index.load("./graphs/fema_tags")
+		_component("entity_index", "ready")
+	except Exception as e:
+		logging.exception("Loading the entity index failed")
+		_component("entity_index", "failed", repr(e))
+
+	# Set ENTITY_MATCHER=0 to always have the LM find the question's entities
+	if os.getenv("ENTITY_MATCHER", "1") == "0":
+		_component("entity_matcher", "disabled")
+	elif index is None:
+		_component("entity_matcher", "failed", "no entity index")
+	else:
+		matcher = EntityMatcher(index.entities)
+		_component("entity_matcher", "ready")
+
+	try:
+		_component("labels", "loading")
+		version = storage.load_graph_version()
+		labelled_version = storage.load_json(labels_version) if os.path.isfile(labels_version) else None
+		stale = labelled_version != version
+		if os.getenv("LABELS_REBUILD", "0") == "1" or not os.path.isfile(labels_cache) or stale:
+			startup["state"] = "building"
+			_component("labels", "building")
+			tree = build_labels()
+			startup["stage"] = "save"
+			print("Save output...")
+			storage.save_json(tree, labels_cache)
+			storage.save_json(version, labels_version)
+			data = tree
+			startup["snapshot"] = False
+
+		_component("labels", "ready")
+		startup["state"] = "ready"
+		startup["stage"] = None
+	except Exception as e:
+		logging.exception("Startup failed")
+		_component("labels", "failed", repr(e))
+		startup["state"] = "failed"
+		startup["error"] = repr(e)
+	startup["finished"] = time.time()
+
+
+# Labels are needed to answer anything (a snapshot counts), the entity index
+# only has to have finished loading, one that failed is done without
+def is_ready():
+	return data is not None and startup["components"]["entity_index"]["state"] in ("ready", "failed")
+
+
+if os.path.isfile(labels_cache):
+	data = storage.load_json(labels_cache)
+	startup["snapshot"] = True
+threading.Thread(target=start, daemon=True).start()
+
+# Shared by every request, cleared when process.py uploads a new graph
+neighbourhoods = NeighbourhoodCache()
+answers = AnswerCache()
+
+# The blocking parts of queries (LM calls, non-async graph backends) run on
+# this many threads
+query_workers = int(os.getenv("QUERY_WORKERS", "8"))
+# At most this many queries run at once, others wait up to QUERY_QUEUE_TIMEOUT
+# seconds for a turn and past QUERY_MAX_QUEUED waiting they're turned away
+max_inflight = int(os.getenv("QUERY_MAX_INFLIGHT", "4"))
+queue_timeout = float(os.getenv("QUERY_QUEUE_TIMEOUT", "30"))
+max_queued = int(os.getenv("QUERY_MAX_QUEUED", "32"))
+
+query_pool = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="query")
+# dspy.asyncify runs predictors on its own limited threads
+dspy.configure(async_max_workers=query_workers)
+query_slots = asyncio.Semaphore(max_inflight)
+query_load = {
+	"inflight": 0,
+	"queued": 0,
+	"rejected": 0,
+	"timed_out": 0,
+}
+
+requests_total = metrics.Counter(
+	"http_requests_total",
+	"Requests handled, by endpoint and status",
+	["endpoint", "status"],
+)
+request_seconds = metrics.Histogram(
+	"http_request_seconds",
+	"Time taken to handle requests, by endpoint",
+	["endpoint"],
+)
+query_stage_seconds = metrics.Histogram(
+	"query_stage_seconds",
+	"Time spent in each stage of answered (uncached) queries",
+	["stage"],
+)
+
+
+def _cache_stats(name):
+	def read():
+		caches = {"answers": answers, "neighbourhoods": neighbourhoods}
+		values = {(cache, ): c.stats()[name] for cache, c in caches.items()}
+		if (llm := llm_cache.stats()) is not None:
+			values[("llm", )] = llm[name]
+		return values
+	return read
+
+
+metrics.Gauge("cache_hits", "Cache hits since startup", _cache_stats("hits"), ["cache"])
+metrics.Gauge("cache_misses", "Cache misses since startup", _cache_stats("misses"), ["cache"])
+metrics.Gauge("cache_hit_rate", "Fraction of cache lookups that hit", _cache_stats("hit_rate"), ["cache"])
+metrics.Gauge("cache_entries", "Entries in each cache", _cache_stats("entries"), ["cache"])
+metrics.Gauge(
+	"query_load",
+	"Queries running, waiting, turned away or timed out waiting",
+	lambda: {(state, ): value for state, value in query_load.items()},
+	["state"],
+)
+metrics.Gauge("query_server_ready", "1 once labels are loaded and the entity index is done loading", lambda: int(is_ready()))
+
+
+@asynccontextmanager
+async def lifespan(app):
+	# asyncio.to_thread (used by query_async) runs on the default executor
+	asyncio.get_running_loop().set_default_executor(query_pool)
+	yield
+	query_pool.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Counts and times every request by its endpoint, the route's path template
+# so checkpoint and label ids don't each get their own series
+# Requests that matched no route (404s for any path) all count as "other"
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+	start = time.perf_counter()
+	status = 500
+	try:
+		response = await call_next(request)
+		status = response.status_code
+		return response
+	finally:
+		# The router fills in the route as it handles the request
+		route = request.scope.get("route")
+		endpoint = getattr(route, "path", None) or "other"
+		request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+		requests_total.inc(endpoint=endpoint, status=str(status))
+
+
+# Waits for one of the max_inflight query slots, raising a 429 if there are
+# too many queries waiting already or none comes up in time
+@asynccontextmanager
+async def query_slot():
+	if query_slots.locked() and query_load["queued"] >= max_queued:
+		query_load["rejected"] += 1
+		raise HTTPException(status_code=429, detail="Too many queries waiting, try again later", headers={"Retry-After": str(int(queue_timeout))})
+
+	query_load["queued"] += 1
+	try:
+		await asyncio.wait_for(query_slots.acquire(), queue_timeout)
+	except TimeoutError:
+		query_load["timed_out"] += 1
+		raise HTTPException(status_code=429, detail="Timed out waiting for a turn, try again later", headers={"Retry-After": str(int(queue_timeout))})
+	finally:
+		query_load["queued"] -= 1
+
+	query_load["inflight"] += 1
+	try:
+		yield
+	finally:
+		query_load["inflight"] -= 1
+		query_slots.release()
 
 
 @app.get("/")
@@ -71,7 +338,18 @@ async def answer_query(item: QueryItem, request: Request):
 	if item.password != "bad-bot-no-api-request-for-you":
 		raise HTTPException(status_code=403, detail="Bots are not entitled to api credits")
 
-	q = query.query_hack(item.question, kg, driver, k=item.k)
+	key = AnswerCache.key(item.question, item.k)
+	if (q := answers.get(key)) is not None:
+		logging.info("Query answered from cache")
+		return dict(q, cached=True)
+
+	tree = data
+	async with query_slot():
+		graph = await asyncio.to_thread(graph_driver)
+		q = await query.query_hack_async(item.question, kg, graph, k=item.k, cache=neighbourhoods, index=index, matcher=matcher)
+	logging.info(f"Query timings - {q["timings"]}")
+	for stage, seconds in q["timings"].items():
+		query_stage_seconds.observe(seconds, stage=stage)
 
 	entities = []
 	for a, r, b in q["statements"]:
@@ -79,24 +357,60 @@ async def answer_query(item: QueryItem, request: Request):
 		entities.append(b)
 	entities = set(entities)
 
-	paths = labels.label_paths_to(data, entities)
-	dend = labels.data_dendrogram(paths)
+	if tree is not None:
+		paths = labels.label_paths_to(tree, entities)
+		dend = labels.data_dendrogram(paths)
 
-	q["graph"] = nx.cytoscape_data(dend)
+		q["graph"] = nx.cytoscape_data(dend)
+	else:
+		# No labels yet, the answer is still worth giving but not keeping
+		q["graph"] = None
 
 	# storage.save_json(q, "inputs/example_but_cooler_and_more_better_actually_the_best_and_greatest_of_all_time.json")
 
+	if tree is not None:
+		answers.put(key, q)
 	return q
 
 
+# 200 once there are labels to serve (a snapshot counts) and the entity index
+# is loaded or has failed to, 503 before that
+# Also reports each component's state and how far the labels rebuild has got
+@app.get("/ready")
+async def get_ready():
+	ready = is_ready()
+	return JSONResponse(
+		status_code=200 if ready else 503,
+		content=dict(startup, ready=ready),
+	)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+	return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+async def get_stats():
+	return {
+		"answers": answers.stats(),
+		"neighbourhoods": neighbourhoods.stats(),
+		"queries": dict(query_load, workers=query_workers, max_inflight=max_inflight, max_queued=max_queued),
+		"llm": llm_cache.stats(),
+	}
+
+
 @app.get("/checkpoint/{checkpoint_id}")
 async def get_checkpoint(checkpoint_id: str):
 	# Basic santitization
-	path = "./graphs/fema_tags/" + checkpoint_id.split("/")[-1]
+	checkpoint = checkpoint_id.split("/")[-1]
 
-	if os.path.isfile(path):
-		data = storage.load_json(path)
-		return data
+	# Just the text and tags, from the text store if it has the chunk
+	texts = text_store.shared("./graphs/fema_tags")
+	if texts is not None and checkpoint in texts:
+		return texts.get(checkpoint)
+	elif checkpoint in chunk_store:
+		return text_store.text_and_tags(chunk_store.get(checkpoint))
 	else:
 		raise HTTPException(status_code=404, detail="Checkpoint not found")
 
@@ -118,9 +432,11 @@ async def get_input(input_id: str):
 # Maybe switch to another method without %20?
 @app.get("/label/{label}")
 async def get_label(label: str):
+	if (tree := data) is None:
+		raise HTTPException(status_code=503, detail="Labels are still being built")
 	if label == "root":
-		return data
-	if tree := labels.find_label(data, label):
+		return tree
+	if tree := labels.find_label(tree, label):
 		return tree
 	else:
 		raise HTTPException(status_code=404, detail="Label not found")
@@ -1,6 +1,9 @@
 import json
 from kg_gen import Graph
 import os
+import sqlite3
+import threading
+import time
 from ast import literal_eval
 
 # Some characters cannot be included in relationships 
@@ -52,10 +55,21 @@ def graph_from_json(data):
 	return graph
 
 
+# Written to a temporary file first so that readers never see half a file
 def save_json(data, path):
 	os.makedirs(os.path.dirname(path), exist_ok=True)
-	with open(path, "w") as f:
+	temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(temp_path, "w") as f:
 		json.dump(data, f, indent=2)
+	os.replace(temp_path, path)
+
+
+def save_text(text, path):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(temp_path, "w", encoding="utf-8") as f:
+		f.write(text)
+	os.replace(temp_path, path)
 
 
 def load_json(path):
@@ -95,3 +109,177 @@ def load_chunk(path):
 	data = load_json(path)
 	data["graph"] = graph_from_json(data["graph"])
 	return data
+
+
+# Rewritten whenever the uploaded graph changes, so caches of it know to clear
+graph_version_file = os.getenv("GRAPH_VERSION_FILE", "graphs/graph_version")
+
+
+def bump_graph_version(path=graph_version_file):
+	save_text(f"{time.time_ns()}-{os.getpid()}", path)
+
+
+# None if the graph has never been uploaded
+def load_graph_version(path=graph_version_file):
+	try:
+		with open(path) as f:
+			return f.read()
+	except FileNotFoundError:
+		return None
+
+
+# Chunk checkpoints are stored by checkpoint name ("chunk-<hash>.json")
+# Either as one json file per chunk (the original layout) or as rows in a 
+# single sqlite file, which is much kinder to shared filesystems
+chunk_database = "checkpoints.sqlite"
+
+
+class DirectoryChunkStore:
+	backend = "json"
+
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, checkpoint):
+		return f"{self.directory}/{checkpoint}"
+
+	def __contains__(self, checkpoint):
+		return os.path.isfile(self.path(checkpoint))
+
+	def __len__(self):
+		return len(self.checkpoints())
+
+	def __iter__(self):
+		for checkpoint in self.checkpoints():
+			yield self.load(checkpoint)
+
+	def checkpoints(self):
+		# Ignores the temporary files of interrupted saves
+		return [f for f in os.listdir(self.directory) if f.startswith("chunk-") and f.endswith(".json")]
+
+	# The checkpoint's json, graph not converted
+	def get(self, checkpoint):
+		return load_json(self.path(checkpoint))
+
+	def text(self, checkpoint):
+		return self.get(checkpoint)["text"]
+
+	def load(self, checkpoint):
+		return load_chunk(self.path(checkpoint))
+
+	def save(self, chunk):
+		save_chunk(chunk, self.path(chunk["tags"]["checkpoint"]))
+
+	def close(self):
+		pass
+
+
+class SqliteChunkStore:
+	backend = "sqlite"
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.path = f"{directory}/{chunk_database}"
+		os.makedirs(directory, exist_ok=True)
+		# Saves can come from process_chunks' worker threads
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(self.path, check_same_thread=False)
+		# Each save is its own transaction, a crash loses at most that chunk
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute("""
+			CREATE TABLE IF NOT EXISTS chunks (
+				checkpoint TEXT PRIMARY KEY,
+				hash TEXT NOT NULL,
+				text TEXT NOT NULL,
+				data TEXT NOT NULL
+			)
+		""")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+		self.connection.commit()
+
+	def _fetch(self, query, params=()):
+		with self.lock:
+			return self.connection.execute(query, params).fetchall()
+
+	def __contains__(self, checkpoint):
+		return len(self._fetch("SELECT 1 FROM chunks WHERE checkpoint = ?", (checkpoint,))) > 0
+
+	def __len__(self):
+		return self._fetch("SELECT COUNT(*) FROM chunks")[0][0]
+
+	def __iter__(self, batch_size=256):
+		# Read a batch at a time under the lock, the connection is shared with
+		# other threads' gets and saves while we iterate
+		last = 0
+		while True:
+			rows = self._fetch("SELECT rowid, data FROM chunks WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, batch_size))
+			if len(rows) == 0:
+				return
+			for rowid, data in rows:
+				data = json.loads(data)
+				data["graph"] = graph_from_json(data["graph"])
+				yield data
+			last = rows[-1][0]
+
+	def checkpoints(self):
+		return [c for c, in self._fetch("SELECT checkpoint FROM chunks ORDER BY rowid")]
+
+	def get(self, checkpoint):
+		rows = self._fetch("SELECT data FROM chunks WHERE checkpoint = ?", (checkpoint,))
+		if len(rows) == 0:
+			raise KeyError(checkpoint)
+		return json.loads(rows[0][0])
+
+	def text(self, checkpoint):
+		rows = self._fetch("SELECT text FROM chunks WHERE checkpoint = ?", (checkpoint,))
+		if len(rows) == 0:
+			raise KeyError(checkpoint)
+		return rows[0][0]
+
+	def load(self, checkpoint):
+		data = self.get(checkpoint)
+		data["graph"] = graph_from_json(data["graph"])
+		return data
+
+	def save(self, chunk):
+		data = dict(chunk)
+		data["graph"] = graph_to_json(data["graph"])
+		with self.lock:
+			self.connection.execute(
+				"INSERT OR REPLACE INTO chunks (checkpoint, hash, text, data) VALUES (?, ?, ?, ?)",
+				(chunk["tags"]["checkpoint"], chunk["hash"], chunk["text"], json.dumps(data)),
+			)
+			self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+
+# Uses the sqlite store if the directory has one, unless told otherwise
+def open_chunk_store(directory, backend=None):
+	if backend is None:
+		backend = "sqlite" if os.path.isfile(f"{directory}/{chunk_database}") else "json"
+	if backend == "sqlite":
+		return SqliteChunkStore(directory)
+	elif backend == "json":
+		return DirectoryChunkStore(directory)
+	else:
+		raise ValueError(f"Unknown checkpoint backend '{backend}'")
+
+
+# Picks a checkpoint name for a chunk and writes it to the chunk's tags
+# A chunk whose hash collides with a different text gets a numbered name
+def resolve_checkpoint(store, chunk):
+	n = 0
+	while True:
+		if n == 0:
+			checkpoint = f"chunk-{chunk["hash"]}.json"
+		else:
+			checkpoint = f"chunk-{chunk["hash"]}-{n}.json"
+		if checkpoint not in store or store.text(checkpoint) == chunk["text"]:
+			break
+		print(f"\tHash collision with '{checkpoint}'")
+		n += 1
+	chunk["tags"]["checkpoint"] = checkpoint
+	return checkpoint
@@ -3,8 +3,8 @@ import hashlib
 from kg_gen import KGGen
 from neo4j import GraphDatabase
 import storage
+import ledger
 import json
-import os
 
 
 # Performance optimization ideas:
@@ -22,8 +22,12 @@ class StreamingKGBuilder:
 		chunk_size=100, 
 		# Chunks will overlap by this many entries 
 		chunk_overlap=10,
+		# LM calls are timed here (default: in the output directory)
+		ledger_file=None,
 	):
 		self.output_dir = output_dir
+		self.store = storage.open_chunk_store(output_dir)
+		ledger.enable(ledger_file or f"{output_dir}/{ledger.file_name}", "streaming")
 		self.driver = GraphDatabase.driver(db_url, auth=(db_user, db_pass))
 		self.kg = KGGen(model=model)
 
@@ -53,35 +57,32 @@ class StreamingKGBuilder:
 		print(f"{len(self.chunk_tags)} tags remain ({self.chunk_tags})")
 
 		text_hash = hashlib.md5(chunk_text.encode()).hexdigest()
-		checkpoint_filename = f"chunk-{text_hash}.json"
-		checkpoint_file = f"{self.output_dir}/{checkpoint_filename}"
-		chunk = None
-		# TODO: collision detection
-		if os.path.isfile(checkpoint_file):
+		chunk = {
+			"text": chunk_text,
+			"hash": text_hash,
+			"tags": {
+				"input_tags": chunk_tags,
+			},
+		}
+		checkpoint_filename = storage.resolve_checkpoint(self.store, chunk)
+		if checkpoint_filename in self.store:
 			# Checkpointing might not be useful in the final implementation, but it's nice to have for testing
 			print("Skip processing - load checkpoint")
-			chunk = storage.load_chunk(checkpoint_file)
+			chunk = self.store.load(checkpoint_filename)
 		else:
 			print("Generate kg")
 			generate_st = time.time()
-			graph = self.kg.generate(input_data=chunk_text)
+			with ledger.tagged(checkpoint=checkpoint_filename):
+				graph = self.kg.generate(input_data=chunk_text)
 			generate_en = time.time()
 			generate_duration = generate_en - generate_st
 			print(f"Processed in {generate_duration:.2f} seconds")
 
 			print("Save to file")
-			chunk = {
-				"text": chunk_text,
-				"hash": text_hash,
-				"time": generate_duration,
-				"graph": graph,
-				"tags": {
-					"checkpoint": checkpoint_filename,
-					"input_tags": chunk_tags,
-				},
-			}
+			chunk["time"] = generate_duration
+			chunk["graph"] = graph
 			print(f"Saving checkpoint as {checkpoint_filename}")
-			storage.save_chunk(chunk, checkpoint_file)		
+			self.store.save(chunk)
 
 		print("Upload to database")
 		tags_str = json.dumps(chunk["tags"])
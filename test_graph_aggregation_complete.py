@@ -1,6 +1,5 @@
 import storage
 import argparse
-import os
 
 
 def missing_relationships(sub, big):
@@ -25,7 +24,8 @@ def main():
 
 	print("Loading graphs...")
 	aggregated = storage.load_graph(f"{args.dir}/aggregated.json")
-	others = [storage.load_chunk(f"{args.dir}/{f}")["graph"] for f in os.listdir(args.dir) if f.startswith("chunk-")]
+	store = storage.open_chunk_store(args.dir)
+	others = (chunk["graph"] for chunk in store)
 
 	heretical = False
 	for i, other in enumerate(others):
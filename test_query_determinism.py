@@ -1,4 +1,5 @@
 import query
+import llm_cache
 import os
 from kg_gen import KGGen
 from neo4j import GraphDatabase
@@ -13,6 +14,10 @@ question = "Where does FEMA get its funding?"
 
 
 def main():
+	# With a cache every response after the first is free (and identical)
+	if os.getenv("LLM_CACHE"):
+		llm_cache.enable(os.getenv("LLM_CACHE"))
+
 	responses = [query.query_hack(question, kg, driver, k=5) for _ in range(0, 5)]
 	
 	equal = True
@@ -25,6 +30,7 @@ def main():
 		print(f"It's deterministic (n={n})")
 	else:
 		print(f"It's nondeterministic (n={n})")
+	llm_cache.print_stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+from array import array
+import threading
+import argparse
+import storage
+import json
+import mmap
+import os
+
+# Chunk texts and tags packed into one file for resolving answer sources
+# Chunk i's text is blob[offsets[4i]:offsets[4i+1]] and its tags (as json)
+# are blob[offsets[4i+2]:offsets[4i+3]], both utf-8
+# names.json has each chunk's checkpoint, hash and chunk_i
+blob_file = "texts.bin"
+offsets_file = "offsets.bin"
+names_file = "names.json"
+
+
+def text_dir(chunks_dir):
+	return f"{chunks_dir}/texts"
+
+
+# Builds the text store of a directory of chunk checkpoints
+def build(chunks_dir, store=None):
+	close_store = store is None
+	if store is None:
+		store = storage.open_chunk_store(chunks_dir)
+	print("Building chunk text store")
+
+	directory = text_dir(chunks_dir)
+	os.makedirs(directory, exist_ok=True)
+	offsets = array("q")
+	names = {"checkpoints": [], "hashes": [], "chunk_is": []}
+	temp_path = f"{directory}/{blob_file}.{os.getpid()}.tmp"
+	with open(temp_path, "wb") as f:
+		position = 0
+		for chunk in store:
+			text = chunk["text"].encode("utf-8")
+			tags = json.dumps(chunk["tags"]).encode("utf-8")
+			f.write(text)
+			f.write(tags)
+			offsets.extend([position, position + len(text), position + len(text), position + len(text) + len(tags)])
+			position += len(text) + len(tags)
+
+			names["checkpoints"].append(chunk["tags"]["checkpoint"])
+			names["hashes"].append(chunk["hash"])
+			names["chunk_is"].append(chunk["tags"].get("chunk_i"))
+	if close_store:
+		store.close()
+
+	# The names go last, they're what readers check for
+	os.replace(temp_path, f"{directory}/{blob_file}")
+	with open(f"{directory}/{offsets_file}.{os.getpid()}.tmp", "wb") as f:
+		offsets.tofile(f)
+	os.replace(f"{directory}/{offsets_file}.{os.getpid()}.tmp", f"{directory}/{offsets_file}")
+	storage.save_json(names, f"{directory}/{names_file}")
+	print(f"\tWrote {len(names["checkpoints"])} chunks ({position/1e6:.1f}MB) to '{directory}'")
+
+
+# Read-only, memory-mapped view of a text store
+# Has the text/get of the chunk stores, without parsing the chunk graphs
+class ChunkTextStore:
+	def __init__(self, chunks_dir):
+		directory = text_dir(chunks_dir)
+		names = storage.load_json(f"{directory}/{names_file}")
+		self.checkpoints = names["checkpoints"]
+		self.hashes = names["hashes"]
+		self.chunk_is = names["chunk_is"]
+		self.ids = {c: i for i, c in enumerate(self.checkpoints)}
+		self.hash_ids = {h: i for i, h in enumerate(self.hashes)}
+
+		self._maps = []
+		self.blob = self._map(f"{directory}/{blob_file}", "B")
+		self.offsets = self._map(f"{directory}/{offsets_file}", "q")
+
+	def _map(self, path, format):
+		with open(path, "rb") as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				return memoryview(b"").cast(format)
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self._maps.append(m)
+		return memoryview(m).cast(format)
+
+	def close(self):
+		self.blob.release()
+		self.offsets.release()
+		for m in self._maps:
+			m.close()
+		self._maps = []
+
+	def __contains__(self, checkpoint):
+		return checkpoint in self.ids
+
+	def __len__(self):
+		return len(self.checkpoints)
+
+	def _id(self, checkpoint):
+		if (i := self.ids.get(checkpoint)) is None:
+			raise KeyError(checkpoint)
+		return i
+
+	# The utf-8 bytes of the chunk's text, without copying them
+	def text_bytes(self, checkpoint):
+		i = self._id(checkpoint)
+		return self.blob[self.offsets[4*i]:self.offsets[4*i+1]]
+
+	def text(self, checkpoint):
+		return str(self.text_bytes(checkpoint), "utf-8")
+
+	def tags(self, checkpoint):
+		i = self._id(checkpoint)
+		return json.loads(str(self.blob[self.offsets[4*i+2]:self.offsets[4*i+3]], "utf-8"))
+
+	# The checkpoint's text and tags (but not its graph)
+	def get(self, checkpoint):
+		i = self._id(checkpoint)
+		return {
+			"text": self.text(checkpoint),
+			"hash": self.hashes[i],
+			"tags": self.tags(checkpoint),
+		}
+
+	def checkpoint_for_hash(self, hash):
+		if (i := self.hash_ids.get(hash)) is None:
+			raise KeyError(hash)
+		return self.checkpoints[i]
+
+	# Chunk numbers restart with every document, so there can be several
+	def checkpoints_for_chunk(self, chunk_i):
+		return [c for c, i in zip(self.checkpoints, self.chunk_is) if i == chunk_i]
+
+
+# What ChunkTextStore.get gives, from a whole checkpoint
+def text_and_tags(chunk):
+	return {
+		"text": chunk["text"],
+		"hash": chunk["hash"],
+		"tags": chunk["tags"],
+	}
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+# One open text store per directory for the whole process, reopened if it's
+# rebuilt, or None if there isn't one
+def shared(chunks_dir):
+	path = f"{text_dir(chunks_dir)}/{names_file}"
+	try:
+		modified = os.stat(path).st_mtime_ns
+	except FileNotFoundError:
+		return None
+	with _shared_lock:
+		store, store_modified = _shared.get(chunks_dir, (None, None))
+		if store is None or store_modified != modified:
+			# The old one may still be in use, it's left for the gc
+			store = ChunkTextStore(chunks_dir)
+			_shared[chunks_dir] = (store, modified)
+		return store
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir")
+	args = parser.parse_args()
+
+	build(args.dir)
+
+
+if __name__ == "__main__":
+	main()